@@ -0,0 +1 @@
+""" Offline benchmarks: run the API in-process against local Qdrant and a fake Ollama, no network needed """
@@ -0,0 +1,278 @@
+""" Offline benchmark of the real FastAPI app: ingestion throughput, chat latency under concurrency and
+memory per workspace. Qdrant runs in-process and Ollama is a deterministic fake, so results are comparable
+between runs and machines; run it before and after a change and diff the JSON reports.
+
+    cd api && pip install -r benchmarks/requirements.txt
+    python -m benchmarks.bench --workspaces 4 --docs-per-workspace 25 --concurrency 1 8 32
+
+The benchmarks drive the API with httpx, which the API itself does not need, so it is listed in
+benchmarks/requirements.txt rather than requirements.txt.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from benchmarks.fakes import FakeOllamaServer, make_document, make_questions
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ORGANIZATION_ID = "bench_org"
+
+
+def add_app_arguments(parser: argparse.ArgumentParser):
+    """ Options for the stand-ins and the API settings under test, shared with the load test """
+    parser.add_argument("--dim", type=int, default=768, help="Embedding size of the fake model (nomic-embed-text: 768)")
+    parser.add_argument("--answer-tokens", type=int, default=64)
+    parser.add_argument("--token-delay", type=float, default=0.0, help="Fake LLM seconds per answer token")
+    parser.add_argument("--embed-delay", type=float, default=0.0, help="Fake embedder seconds per text")
+    parser.add_argument("--top-k", type=int, help="RAG_TOP_K")
+    parser.add_argument("--chunk-tokens", type=int, help="CHUNK_TOKEN_BUDGET")
+    parser.add_argument("--hybrid", action="store_true", help="HYBRID_RETRIEVAL=true")
+    parser.add_argument("--multitenant", action="store_true", help="QDRANT_MULTITENANT=true")
+    parser.add_argument("--semantic-cache", action="store_true",
+                        help="Leave the semantic answer cache on (off by default so every chat does the full work)")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workspaces", type=int, default=4)
+    parser.add_argument("--docs-per-workspace", type=int, default=25)
+    parser.add_argument("--sections", type=int, default=8, help="Sections per synthetic document")
+    parser.add_argument("--words-per-section", type=int, default=120)
+    parser.add_argument("--chat-requests", type=int, default=200, help="Chat requests per concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--stream", action="store_true", help="Benchmark /chat/stream instead of /chat")
+    parser.add_argument("--report", default="benchmark_report.json", help="Where to write the JSON report")
+    add_app_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def configure_environment(args: argparse.Namespace, ollama_url: str, workdir: str):
+    """ Point the API at the local stand-ins; must run before main is imported """
+    env = {
+        "OLLAMA_HOST": ollama_url,
+        "QDRANT_LOCATION": ":memory:",
+        "SEMANTIC_CACHE_ENABLED": str(args.semantic_cache).lower(),
+        "HYBRID_RETRIEVAL": str(args.hybrid).lower(),
+        "QDRANT_MULTITENANT": str(args.multitenant).lower(),
+        "EMBEDDING_CACHE_DB": os.path.join(workdir, "embedding_cache.db"),
+        "LOG_FILE": os.path.join(workdir, "app.log"),
+        "TRACE_EXPORTER": "none",
+    }
+    for name, value in (("RAG_TOP_K", args.top_k), ("CHUNK_TOKEN_BUDGET", args.chunk_tokens)):
+        if value is not None:
+            env[name] = str(value)
+    os.environ.update(env)
+
+
+def rss_bytes() -> int:
+    """ Current resident set size; falls back to the peak where /proc is not available """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def percentiles(values: List[float]) -> dict:
+    """ Nearest-rank p50/p95/p99 plus mean and max, in milliseconds """
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))] * 1000
+
+    return {"count": len(ordered), "mean_ms": sum(ordered) / len(ordered) * 1000, "p50_ms": rank(50),
+            "p95_ms": rank(95), "p99_ms": rank(99), "max_ms": ordered[-1] * 1000}
+
+
+def workspace_id(index: int) -> str:
+    return f"ws_{index}"
+
+
+async def wait_for_jobs(client, job_ids: List[str], poll_interval: float = 0.05) -> List[dict]:
+    pending = set(job_ids)
+    finished = {}
+    while pending:
+        for job_id in list(pending):
+            job = (await client.get(f"/jobs/{job_id}")).json()
+            if job["status"] in ("completed", "failed"):
+                finished[job_id] = job
+                pending.discard(job_id)
+        if pending:
+            await asyncio.sleep(poll_interval)
+    return [finished[job_id] for job_id in job_ids]
+
+
+async def bench_ingestion(client, args: argparse.Namespace) -> dict:
+    """ Queue every document through /upload-doc and time until the last ingestion job finishes """
+    documents = [make_document(str(w * args.docs_per_workspace + d + 1), ORGANIZATION_ID, workspace_id(w), args.sections,
+                               args.words_per_section, args.seed)
+                 for w in range(args.workspaces) for d in range(args.docs_per_workspace)]
+    rss_before = rss_bytes()
+    request_latencies, job_ids = [], []
+    start = time.perf_counter()
+    for document in documents:
+        request_start = time.perf_counter()
+        response = await client.post("/upload-doc", json=document)
+        request_latencies.append(time.perf_counter() - request_start)
+        response.raise_for_status()
+        job_ids.append(response.json()["job_id"])
+    jobs = await wait_for_jobs(client, job_ids)
+    elapsed = time.perf_counter() - start
+    rss_after = rss_bytes()
+
+    chunks = sum(job["chunks_upserted"] for job in jobs)
+    return {
+        "ingestion": {
+            "documents": len(documents),
+            "failed": sum(1 for job in jobs if job["status"] == "failed"),
+            "chunks": chunks,
+            "seconds": elapsed,
+            "documents_per_second": len(documents) / elapsed,
+            "chunks_per_second": chunks / elapsed,
+            "upload_request_latency": percentiles(request_latencies),
+        },
+        "memory": {
+            "rss_before_bytes": rss_before,
+            "rss_after_bytes": rss_after,
+            "bytes_per_workspace": (rss_after - rss_before) / max(args.workspaces, 1),
+            "bytes_per_chunk": (rss_after - rss_before) / max(chunks, 1),
+        },
+    }
+
+
+async def bench_chat(client, args: argparse.Namespace, concurrency: int, questions: List[str]) -> dict:
+    """ Send args.chat_requests questions spread over the workspaces, at most `concurrency` at a time """
+    path = "/chat/stream" if args.stream else "/chat"
+    latencies, errors = [], 0
+    slots = asyncio.Semaphore(concurrency)
+
+    async def ask(index: int):
+        nonlocal errors
+        payload = {"question": questions[index % len(questions)], "organization_id": ORGANIZATION_ID,
+                   "workspace_id": workspace_id(index % args.workspaces)}
+        async with slots:
+            start = time.perf_counter()
+            try:
+                response = await client.post(path, json=payload)
+                ok = response.status_code == 200
+            except Exception:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(ask(index) for index in range(args.chat_requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        "endpoint": path,
+        "concurrency": concurrency,
+        "requests": args.chat_requests,
+        "errors": errors,
+        "seconds": elapsed,
+        "requests_per_second": args.chat_requests / elapsed,
+        "latency": percentiles(latencies),
+    }
+
+
+async def run(args: argparse.Namespace, app) -> dict:
+    import httpx
+
+    # The client calls the ASGI app directly in this event loop, like a single uvicorn worker
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        report = await bench_ingestion(client, args)
+        questions = make_questions(args.chat_requests, args.seed)
+        report["chat"] = [await bench_chat(client, args, concurrency, questions)
+                          for concurrency in args.concurrency]
+    return report
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=API_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(report: dict):
+    ingestion = report["ingestion"]
+    print(f"ingestion: {ingestion['documents']} docs ({ingestion['failed']} failed), {ingestion['chunks']} chunks "
+          f"in {ingestion['seconds']:.2f}s = {ingestion['documents_per_second']:.1f} docs/s, "
+          f"{ingestion['chunks_per_second']:.1f} chunks/s")
+    print(f"memory: {report['memory']['bytes_per_workspace'] / 1024 / 1024:.1f} MiB per workspace")
+    for result in report["chat"]:
+        latency = result["latency"]
+        print(f"{result['endpoint']} c={result['concurrency']}: {result['requests_per_second']:.1f} req/s, "
+              f"p50 {latency.get('p50_ms', 0):.0f}ms p95 {latency.get('p95_ms', 0):.0f}ms "
+              f"p99 {latency.get('p99_ms', 0):.0f}ms, {result['errors']} errors")
+
+
+def start_app(args: argparse.Namespace):
+    """ Start the fake Ollama, point the API at it and import main. Returns (main module, server, workdir). """
+    server = FakeOllamaServer(dim=args.dim, answer_tokens=args.answer_tokens, token_delay=args.token_delay,
+                              embed_delay=args.embed_delay).start()
+
+    # The API keeps its SQLite databases and log in the working directory; isolate them per run
+    workdir = tempfile.mkdtemp(prefix="rag-bench-")
+    configure_environment(args, server.url, workdir)
+    os.chdir(workdir)
+    sys.path.insert(0, API_DIR)
+    warnings.filterwarnings("ignore", message="Payload indexes have no effect in the local Qdrant")
+    import main as api
+    return api, server, workdir
+
+
+def stop_app(server: FakeOllamaServer):
+    from job_utils import shutdown_ingestion_workers
+    from logging_utils import stop_logging
+
+    shutdown_ingestion_workers()
+    stop_logging()
+    server.stop()
+
+
+def run_metadata(args: argparse.Namespace) -> dict:
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "config": vars(args),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpu_count": os.cpu_count()},
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    report_path = os.path.abspath(args.report)
+    api, server, workdir = start_app(args)
+    try:
+        report = asyncio.run(run(args, api.app))
+    finally:
+        stop_app(server)
+
+    report = {**run_metadata(args), **report}
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print_summary(report)
+    print(f"report written to {report_path} (working files in {workdir})")
+
+
+if __name__ == "__main__":
+    main()
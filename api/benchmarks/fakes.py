@@ -0,0 +1,148 @@
+import json
+import math
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+# Deterministic stand-ins for the services the API talks to, so benchmark runs are repeatable and offline.
+# Qdrant runs in-process (QDRANT_LOCATION=":memory:"); Ollama is replaced by the small HTTP server below.
+
+WORDS = (
+    "agreement party parties clause term termination notice payment invoice liability indemnity warranty "
+    "confidential information disclosure obligation breach remedy dispute arbitration governing law "
+    "jurisdiction assignment subcontractor service level availability fee renewal effective date schedule "
+    "appendix amendment waiver force majeure insurance audit records data protection processor controller "
+    "security incident intellectual property licence deliverable acceptance milestone delay penalty"
+).split()
+
+
+def fake_embedding(text: str, dim: int) -> List[float]:
+    """ Normalised hashed bag of words: similar texts get similar vectors, identical texts identical ones """
+    vector = [0.0] * dim
+    for word in text.lower().split():
+        vector[zlib.crc32(word.encode("utf-8")) % dim] += 1.0
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def fake_answer(prompt: str, tokens: int) -> List[str]:
+    """ Answer tokens seeded by the prompt, with a short <think> block like the reasoning models emit """
+    rng = random.Random(zlib.crc32(prompt.encode("utf-8")))
+    return ["<think>", "checking", " the", " context", "</think>"] + [f" {rng.choice(WORDS)}" for _ in range(tokens)]
+
+
+class _OllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path == "/api/embed":
+            self._embed(body)
+        elif self.path == "/api/chat":
+            self._chat(body)
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def _embed(self, body: dict):
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        if self.server.embed_delay:
+            time.sleep(self.server.embed_delay * len(texts))
+        self._send_json({"model": body["model"], "embeddings": [fake_embedding(t, self.server.dim) for t in texts]})
+
+    def _chat(self, body: dict):
+        prompt = body["messages"][-1]["content"] if body.get("messages") else ""
+        tokens = fake_answer(prompt, self.server.answer_tokens)
+        done = {"model": body["model"], "created_at": "2024-01-01T00:00:00Z", "done": True, "done_reason": "stop",
+                "prompt_eval_count": len(prompt) // 4, "eval_count": len(tokens)}
+        if not body.get("stream", True):
+            time.sleep(self.server.token_delay * len(tokens))
+            self._send_json({**done, "message": {"role": "assistant", "content": "".join(tokens)}})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for token in tokens:
+            if self.server.token_delay:
+                time.sleep(self.server.token_delay)
+            self._write_chunk({"model": body["model"], "created_at": "2024-01-01T00:00:00Z",
+                               "message": {"role": "assistant", "content": token}, "done": False})
+        self._write_chunk({**done, "message": {"role": "assistant", "content": ""}})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, payload: dict):
+        data = (json.dumps(payload) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+    def _send_json(self, payload: dict):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeOllamaServer:
+    """ Serves /api/embed and /api/chat like Ollama, deterministically and without a model.
+    token_delay and embed_delay (seconds per token / per text) simulate model speed. """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, dim: int = 768, answer_tokens: int = 64,
+                 token_delay: float = 0.0, embed_delay: float = 0.0):
+        self._server = ThreadingHTTPServer((host, port), _OllamaHandler)
+        self._server.daemon_threads = True
+        self._server.dim = dim
+        self._server.answer_tokens = answer_tokens
+        self._server.token_delay = token_delay
+        self._server.embed_delay = embed_delay
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeOllamaServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-ollama", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# --- Synthetic data ---
+def make_document(file_id: str, organization_id: str, workspace_id: str, sections: int = 8,
+                  words_per_section: int = 120, seed: int = 0) -> dict:
+    """ A FileUpload payload of numbered template sections with deterministic pseudo-legal text.
+    Chats scoped to a file filter on metadata.file_id; a numeric file_id also sets the template_id. """
+    rng = random.Random(f"{seed}:{file_id}")
+    file = []
+    for number in range(1, sections + 1):
+        heading = f"{number}. {rng.choice(WORDS).title()} {rng.choice(WORDS)}"
+        content = " ".join(rng.choice(WORDS) for _ in range(words_per_section))
+        file.append({"heading": heading, "content": f"{number}.1 {content}"})
+    return {
+        "file_id": file_id,
+        "filename": f"{file_id}.json",
+        "organization_id": organization_id,
+        "workspace_id": workspace_id,
+        "file": file,
+    }
+
+
+def make_questions(count: int, seed: int = 0) -> List[str]:
+    """ Distinct questions drawn from the same vocabulary as the documents """
+    rng = random.Random(seed)
+    return [f"What does the {rng.choice(WORDS)} clause say about {rng.choice(WORDS)} and {rng.choice(WORDS)}? "
+            f"(#{index})" for index in range(count)]
@@ -0,0 +1,317 @@
+""" Open-loop load test with an SLO check. Replays mixed traffic (chat with and without file_id, uploads,
+updates, deletes, list-docs) from many tenants at Poisson arrival rates against the API served by uvicorn,
+backed by in-process Qdrant and the fake Ollama. Each --rate is one stage; the report gives throughput,
+latency percentiles and error rates per operation, and the highest rate whose chat latency and error rate
+stayed within the SLO. Exits with status 1 if no stage met it.
+
+    cd api && pip install -r benchmarks/requirements.txt
+    python -m benchmarks.loadtest --tenants 3 --workspaces-per-tenant 4 --rate 5 10 20 40 \\
+        --duration 60 --token-delay 0.02 --slo-chat-p99-ms 5000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from benchmarks.bench import add_app_arguments, percentiles, run_metadata, start_app, stop_app, wait_for_jobs
+from benchmarks.fakes import WORDS, make_document
+
+DEFAULT_MIX = "chat=55,chat_file=15,list=12,upload=8,update=6,delete=4"
+CHAT_OPERATIONS = ("chat", "chat_file")
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in Traffic.OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}; expected one of {Traffic.OPERATIONS}")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tenants", type=int, default=3, help="Organizations")
+    parser.add_argument("--workspaces-per-tenant", type=int, default=4)
+    parser.add_argument("--docs-per-workspace", type=int, default=10, help="Documents loaded before the test")
+    parser.add_argument("--sections", type=int, default=8, help="Sections per synthetic document")
+    parser.add_argument("--words-per-section", type=int, default=120)
+    parser.add_argument("--rate", type=float, nargs="+", default=[5, 10, 20],
+                        help="Arrivals per second, one stage per value")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of arrivals per stage")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help=f"Operation weights (default {DEFAULT_MIX})")
+    parser.add_argument("--sessions", type=int, default=0,
+                        help="Chats reuse this many session ids, exercising conversation memory (0: stateless)")
+    parser.add_argument("--stream", action="store_true", help="Send chats to /chat/stream and read the whole body")
+    parser.add_argument("--request-timeout", type=float, default=120)
+    parser.add_argument("--slo-chat-p99-ms", type=float, default=5000)
+    parser.add_argument("--slo-error-rate", type=float, default=0.01)
+    parser.add_argument("--report", default="loadtest_report.json", help="Where to write the JSON report")
+    add_app_arguments(parser)
+    args = parser.parse_args(argv)
+    if isinstance(args.mix, str):
+        args.mix = parse_mix(args.mix)
+    return args
+
+
+class Traffic:
+    """ Picks the next operation by weight and builds its request against the documents known to exist """
+    OPERATIONS = ("chat", "chat_file", "list", "upload", "update", "delete")
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.workspaces = [(f"org_{t}", f"ws_{w}") for t in range(args.tenants)
+                           for w in range(args.workspaces_per_tenant)]
+        self.documents = {workspace: [] for workspace in self.workspaces}
+        self.sessions = [f"load-session-{index}" for index in range(args.sessions)]
+        self.job_ids = []
+        self._next_document = 0
+
+    def new_document(self, organization_id: str, workspace_id: str) -> dict:
+        self._next_document += 1
+        return make_document(str(self._next_document), organization_id, workspace_id, self.args.sections,
+                             self.args.words_per_section, self.args.seed)
+
+    def pick(self) -> str:
+        operations = list(self.args.mix)
+        return self.rng.choices(operations, weights=[self.args.mix[op] for op in operations])[0]
+
+    def question(self) -> str:
+        words = self.rng.sample(WORDS, 3)
+        return f"What does the {words[0]} clause say about {words[1]} and {words[2]}?"
+
+    def request(self, operation: str):
+        """ (operation actually sent, method, path, json body); falls back to a plain chat when a document
+        operation has no document to act on """
+        organization_id, workspace_id = workspace = self.rng.choice(self.workspaces)
+        documents = self.documents[workspace]
+        if operation in ("chat_file", "update", "delete") and not documents:
+            operation = "chat"
+
+        if operation in CHAT_OPERATIONS:
+            body = {"question": self.question(), "organization_id": organization_id, "workspace_id": workspace_id}
+            if operation == "chat_file":
+                body["file_id"] = self.rng.choice(documents)
+            if self.sessions:
+                body["session_id"] = self.rng.choice(self.sessions)
+            return operation, "POST", "/chat/stream" if self.args.stream else "/chat", body
+        if operation == "list":
+            return operation, "GET", f"/list-docs/organization/{organization_id}/workspace/{workspace_id}", None
+        if operation == "upload":
+            document = self.new_document(organization_id, workspace_id)
+            documents.append(document["file_id"])
+            return operation, "POST", "/upload-doc", document
+        if operation == "update":
+            document = self.new_document(organization_id, workspace_id)
+            document["file_id"] = document["filename"] = self.rng.choice(documents)
+            return operation, "POST", "/update-doc", document
+        # delete: forget the document straight away so later requests do not target it
+        file_id = documents.pop(self.rng.randrange(len(documents)))
+        return operation, "POST", "/delete-doc", {"organization_id": organization_id,
+                                                  "workspace_id": workspace_id, "file_id": file_id}
+
+
+class StageStats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.error_samples = defaultdict(list)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def record(self, operation: str, seconds: float, error: Optional[str]):
+        if error is None:
+            self.latencies[operation].append(seconds)
+            return
+        self.errors[operation] += 1
+        if len(self.error_samples[operation]) < 3:
+            self.error_samples[operation].append(error)
+
+    def summary(self, seconds: float) -> dict:
+        operations = {}
+        for operation in sorted(set(self.latencies) | set(self.errors)):
+            ok, errors = len(self.latencies[operation]), self.errors[operation]
+            operations[operation] = {
+                "requests": ok + errors,
+                "errors": errors,
+                "error_rate": errors / (ok + errors),
+                "throughput_per_second": ok / seconds,
+                "latency": percentiles(self.latencies[operation]),
+                "error_samples": self.error_samples[operation],
+            }
+        return operations
+
+
+async def send(client, traffic: Traffic, stats: StageStats, operation: str):
+    operation, method, path, body = traffic.request(operation)
+    stats.in_flight += 1
+    stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+    start = time.perf_counter()
+    error = None
+    try:
+        response = await client.request(method, path, json=body)
+        if response.status_code >= 400:
+            error = f"HTTP {response.status_code}: {response.text[:200]}"
+        elif path == "/delete-doc" and "error" in response.json():
+            error = response.json()["error"]
+        elif operation in ("upload", "update"):
+            traffic.job_ids.append(response.json()["job_id"])
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        stats.in_flight -= 1
+    stats.record(operation, time.perf_counter() - start, error)
+
+
+async def run_stage(client, traffic: Traffic, rate: float, duration: float) -> dict:
+    """ Open loop: arrivals follow a Poisson process regardless of how fast responses come back, so a
+    saturated server shows up as growing latency rather than as a lower offered rate """
+    loop = asyncio.get_running_loop()
+    stats = StageStats()
+    tasks = []
+    start = loop.time()
+    next_arrival = start
+    while True:
+        next_arrival += traffic.rng.expovariate(rate)
+        if next_arrival - start >= duration:
+            break
+        await asyncio.sleep(max(0.0, next_arrival - loop.time()))
+        tasks.append(asyncio.create_task(send(client, traffic, stats, traffic.pick())))
+    await asyncio.gather(*tasks)
+    # Measured until the last response, so the tail of a saturated stage counts against its throughput
+    elapsed = loop.time() - start
+
+    operations = stats.summary(elapsed)
+    total = sum(op["requests"] for op in operations.values())
+    errors = sum(op["errors"] for op in operations.values())
+    chat_latencies = [s for op in CHAT_OPERATIONS for s in stats.latencies[op]]
+    chat_requests = sum(operations[op]["requests"] for op in CHAT_OPERATIONS if op in operations)
+    chat_errors = sum(operations[op]["errors"] for op in CHAT_OPERATIONS if op in operations)
+    return {
+        "offered_rate": rate,
+        "requests": total,
+        "seconds": elapsed,
+        "throughput_per_second": (total - errors) / elapsed,
+        "error_rate": errors / total if total else 0.0,
+        "max_in_flight": stats.max_in_flight,
+        "chat": {"requests": chat_requests, "error_rate": chat_errors / chat_requests if chat_requests else 0.0,
+                 "latency": percentiles(chat_latencies)},
+        "operations": operations,
+    }
+
+
+def meets_slo(stage: dict, args: argparse.Namespace) -> bool:
+    chat = stage["chat"]
+    return (chat["latency"].get("p99_ms", 0.0) <= args.slo_chat_p99_ms
+            and stage["error_rate"] <= args.slo_error_rate and chat["error_rate"] <= args.slo_error_rate)
+
+
+async def seed_documents(client, traffic: Traffic, args: argparse.Namespace) -> dict:
+    """ Load the starting documents of every workspace through /upload-docs/bulk """
+    start = time.perf_counter()
+    indexed = failed = 0
+    for organization_id, workspace_id in traffic.workspaces:
+        documents = [traffic.new_document(organization_id, workspace_id) for _ in range(args.docs_per_workspace)]
+        if not documents:
+            continue
+        response = await client.post("/upload-docs/bulk", json=documents)
+        response.raise_for_status()
+        for result in response.json()["results"]:
+            if result["status"] == "indexed":
+                traffic.documents[(organization_id, workspace_id)].append(result["file_id"])
+                indexed += 1
+            else:
+                failed += 1
+    return {"documents": indexed, "failed": failed, "seconds": time.perf_counter() - start}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ServerThread:
+    """ uvicorn on its own thread and event loop, so the load generator does not share a loop with the API """
+
+    def __init__(self, app):
+        import uvicorn
+
+        self.port = free_port()
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, name="uvicorn", daemon=True)
+
+    def start(self) -> "ServerThread":
+        self.thread.start()
+        while not self.server.started:
+            if not self.thread.is_alive():
+                raise RuntimeError("uvicorn failed to start")
+            time.sleep(0.05)
+        return self
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+async def run(args: argparse.Namespace, base_url: str) -> dict:
+    import httpx
+
+    traffic = Traffic(args)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.request_timeout, limits=limits) as client:
+        report = {"seed": await seed_documents(client, traffic, args), "stages": []}
+        for rate in args.rate:
+            stage = await run_stage(client, traffic, rate, args.duration)
+            stage["meets_slo"] = meets_slo(stage, args)
+            report["stages"].append(stage)
+            print_stage(stage)
+
+        jobs = await wait_for_jobs(client, traffic.job_ids)
+        report["ingestion_jobs"] = {"submitted": len(jobs),
+                                    "failed": sum(1 for job in jobs if job["status"] == "failed")}
+
+    passing = [stage["offered_rate"] for stage in report["stages"] if stage["meets_slo"]]
+    report["slo"] = {"chat_p99_ms": args.slo_chat_p99_ms, "error_rate": args.slo_error_rate,
+                     "max_rate_within_slo": max(passing) if passing else None}
+    return report
+
+
+def print_stage(stage: dict):
+    latency = stage["chat"]["latency"]
+    print(f"rate {stage['offered_rate']:g}/s: {stage['requests']} requests, "
+          f"{stage['throughput_per_second']:.1f} ok/s, errors {stage['error_rate']:.1%}, "
+          f"chat p50 {latency.get('p50_ms', 0):.0f}ms p95 {latency.get('p95_ms', 0):.0f}ms "
+          f"p99 {latency.get('p99_ms', 0):.0f}ms, max in flight {stage['max_in_flight']}"
+          f"{'' if stage['meets_slo'] else '  [SLO missed]'}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    report_path = os.path.abspath(args.report)
+    api, fake_ollama, workdir = start_app(args)
+    server = ServerThread(api.app).start()
+    try:
+        report = asyncio.run(run(args, f"http://127.0.0.1:{server.port}"))
+    finally:
+        server.stop()
+        stop_app(fake_ollama)
+
+    report = {**run_metadata(args), **report}
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"max rate within SLO: {report['slo']['max_rate_within_slo']}")
+    print(f"report written to {report_path} (working files in {workdir})")
+    return 0 if report["slo"]["max_rate_within_slo"] is not None else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
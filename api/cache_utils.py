@@ -0,0 +1,223 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class LRUTTLCache:
+    """ Thread-safe LRU cache whose entries also expire after `ttl` seconds """
+
+    def __init__(self, maxsize: int = 128, ttl: float = 600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_create(self, key, factory):
+        """ Return the cached value for key, building it with factory() on a miss """
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            # Build outside the lock so a slow factory does not block other keys
+            value = factory()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, predicate):
+        """ Drop every entry whose key matches predicate(key); returns the number removed """
+        with self._lock:
+            stale = [key for key in self._data if predicate(key)]
+            for key in stale:
+                del self._data[key]
+            return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class SemanticAnswerCache:
+    """ Answers keyed by a bucket (organization, workspace, file_id, model) and the question embedding.
+    A question whose cosine similarity to a cached one reaches `threshold` reuses the stored answer. """
+
+    def __init__(self, threshold: float = 0.95, max_buckets: int = 256, max_entries_per_bucket: int = 256,
+                 ttl: float = 3600):
+        self.threshold = threshold
+        self.max_buckets = max_buckets
+        self.max_entries_per_bucket = max_entries_per_bucket
+        self.ttl = ttl
+        self._buckets = OrderedDict()
+        # Bumped on every invalidation so answers generated before a content change are not stored
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, bucket_key, embedding):
+        """ Return the cached answer closest to embedding, or None """
+        query = self._normalize(embedding)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(bucket_key)
+            if bucket:
+                for question in [q for q, entry in bucket.items() if entry[2] < now]:
+                    del bucket[question]
+            if not bucket:
+                self.misses += 1
+                return None
+
+            questions = list(bucket.keys())
+            similarities = np.stack([bucket[q][0] for q in questions]) @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            self._buckets.move_to_end(bucket_key)
+            bucket.move_to_end(questions[best])
+            self.hits += 1
+            return bucket[questions[best]][1]
+
+    def generation(self, organization_id, workspace_id):
+        """ Token to pass to store(); a later invalidation of the workspace makes it stale """
+        with self._lock:
+            return self._generations.get((organization_id, workspace_id), 0)
+
+    def store(self, bucket_key, question, embedding, answer, generation=None):
+        """ Cache an answer; bucket_key must start with (organization_id, workspace_id) """
+        with self._lock:
+            if generation is not None and generation != self._generations.get(bucket_key[:2], 0):
+                return
+            bucket = self._buckets.setdefault(bucket_key, OrderedDict())
+            bucket[question] = (self._normalize(embedding), answer, time.monotonic() + self.ttl)
+            bucket.move_to_end(question)
+            self._buckets.move_to_end(bucket_key)
+            while len(bucket) > self.max_entries_per_bucket:
+                bucket.popitem(last=False)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+
+    def invalidate_workspace(self, organization_id, workspace_id):
+        """ Drop every bucket of a workspace whose content changed """
+        with self._lock:
+            workspace = (organization_id, workspace_id)
+            self._generations[workspace] = self._generations.get(workspace, 0) + 1
+            stale = [key for key in self._buckets if key[:2] == workspace]
+            for key in stale:
+                del self._buckets[key]
+            return len(stale)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "buckets": len(self._buckets),
+                "entries": sum(len(bucket) for bucket in self._buckets.values()),
+                "threshold": self.threshold,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class SQLiteEmbeddingCache:
+    """ Persistent embedding store keyed by (model name, SHA-256 of the chunk text) """
+
+    # SQLite caps the number of bound parameters per statement
+    BATCH_SIZE = 500
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS embedding_cache (
+                                model TEXT NOT NULL,
+                                text_hash TEXT NOT NULL,
+                                vector BLOB NOT NULL,
+                                PRIMARY KEY (model, text_hash)
+                            ) WITHOUT ROWID''')
+
+    def _connection(self):
+        # One connection per thread; indexing runs on worker threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, hashes):
+        """ Return {text_hash: vector} for the hashes that are cached """
+        hashes = list(hashes)
+        found = {}
+        conn = self._connection()
+        for start in range(0, len(hashes), self.BATCH_SIZE):
+            batch = hashes[start:start + self.BATCH_SIZE]
+            rows = conn.execute(
+                f"SELECT text_hash, vector FROM embedding_cache WHERE model = ? AND text_hash IN ({','.join('?' * len(batch))})",
+                (model, *batch),
+            ).fetchall()
+            for text_hash, blob in rows:
+                found[text_hash] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, model: str, items):
+        """ Store (text_hash, vector) pairs """
+        rows = [(model, text_hash, np.asarray(vector, dtype=np.float32).tobytes()) for text_hash, vector in items]
+        if not rows:
+            return
+        with self._connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (model, text_hash, vector) VALUES (?, ?, ?)", rows
+            )
@@ -0,0 +1,65 @@
+import os
+from typing import Iterator, List, Optional
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from pydantic_models import FileItem, FileUpload
+from prompt_utils import estimate_tokens
+
+# Uploaded templates are chunked along their (heading, content) sections: consecutive sections are packed
+# into one chunk up to CHUNK_TOKEN_BUDGET, and only a section longer than the budget is split, repeating its
+# heading on every piece. Chunk text is just "heading\ncontent" with no JSON keys or braces.
+CHUNK_TOKEN_BUDGET = int(os.getenv("CHUNK_TOKEN_BUDGET", "768"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "48"))
+# estimate_tokens counts about four characters per token; the character splitter works in characters
+CHARS_PER_TOKEN = 4
+
+
+def template_id(file_id: str) -> Optional[int]:
+    """ The integer template id cited in answers, when the file_id is numeric """
+    return int(file_id) if file_id.strip().isdigit() else None
+
+
+class SectionChunker:
+    """ Packs a FileUpload's sections into chunks of at most token_budget tokens """
+
+    def __init__(self, token_budget: int = CHUNK_TOKEN_BUDGET, overlap_tokens: int = CHUNK_OVERLAP_TOKENS):
+        self.token_budget = token_budget
+        self.overlap_tokens = overlap_tokens
+
+    def _section_pieces(self, item: FileItem) -> List[str]:
+        heading = item.heading.strip()
+        content = (item.content or "").strip()
+        text = f"{heading}\n{content}" if heading and content else heading or content
+        if estimate_tokens(text) <= self.token_budget:
+            return [text] if text else []
+
+        # Split the content alone so every piece can carry the heading
+        room = max(self.token_budget - estimate_tokens(heading), self.overlap_tokens + 1)
+        splitter = RecursiveCharacterTextSplitter(chunk_size=room * CHARS_PER_TOKEN,
+                                                  chunk_overlap=self.overlap_tokens * CHARS_PER_TOKEN)
+        return [f"{heading}\n{piece}" if heading else piece for piece in splitter.split_text(content)]
+
+    def split(self, file: FileUpload) -> Iterator[Document]:
+        """ Yield the chunks with the headings they cover, the filename and the template id as metadata """
+        base_metadata = {"filename": file.filename}
+        if template_id(file.file_id) is not None:
+            base_metadata["template_id"] = template_id(file.file_id)
+
+        texts, headings, tokens = [], [], 0
+        for item in file.file:
+            for text in self._section_pieces(item):
+                text_tokens = estimate_tokens(text)
+                if texts and tokens + text_tokens > self.token_budget:
+                    yield Document(page_content="\n\n".join(texts), metadata={**base_metadata, "headings": headings})
+                    texts, headings, tokens = [], [], 0
+                texts.append(text)
+                if item.heading.strip() and item.heading.strip() not in headings:
+                    headings.append(item.heading.strip())
+                tokens += text_tokens
+        if texts:
+            yield Document(page_content="\n\n".join(texts), metadata={**base_metadata, "headings": headings})
+
+
+section_chunker = SectionChunker()
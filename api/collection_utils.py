@@ -0,0 +1,135 @@
+import os
+from typing import Optional
+
+from qdrant_client.http import models
+
+# Per-deployment storage profile for the Qdrant collections. QDRANT_PROFILE picks a preset and the other
+# variables override single settings of it. New collections are created with the profile; existing ones are
+# brought in line with `python manage.py apply-profile`.
+#   default  float32 vectors and HNSW graph in RAM (Qdrant's own defaults)
+#   scalar   int8 copies of the vectors in RAM, originals on disk, results rescored with the originals: ~4x less RAM
+#   binary   1-bit copies in RAM, originals on disk, rescored with more oversampling: ~32x less RAM, but only
+#            accurate enough for embeddings of roughly 1024 dimensions and up
+PROFILE_PRESETS = {
+    "default": {},
+    "scalar": {"quantization": "scalar", "on_disk": True, "oversampling": 2.0},
+    "binary": {"quantization": "binary", "on_disk": True, "oversampling": 3.0},
+}
+QUANTIZATION_TYPES = ("none", "scalar", "binary")
+
+
+class CollectionProfile:
+    """ Vector storage, quantization and HNSW settings shared by every collection of a deployment """
+
+    def __init__(self, name: str = "default", quantization: str = "none", on_disk: bool = False,
+                 hnsw_m: int = 16, hnsw_ef_construct: int = 100, hnsw_on_disk: bool = False,
+                 rescore: bool = True, oversampling: Optional[float] = None, hnsw_ef: Optional[int] = None):
+        if quantization not in QUANTIZATION_TYPES:
+            raise ValueError(f"Unknown quantization {quantization!r}; expected one of {QUANTIZATION_TYPES}")
+        self.name = name
+        self.quantization = quantization
+        self.on_disk = on_disk
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construct = hnsw_ef_construct
+        self.hnsw_on_disk = hnsw_on_disk
+        self.rescore = rescore
+        self.oversampling = oversampling
+        self.hnsw_ef = hnsw_ef
+
+    def vectors_config(self, size: int) -> models.VectorParams:
+        return models.VectorParams(size=size, distance=models.Distance.COSINE, on_disk=self.on_disk)
+
+    def sparse_vectors_config(self, name: str) -> dict:
+        """ BM25 vectors; Qdrant applies the IDF part at query time """
+        return {name: models.SparseVectorParams(modifier=models.Modifier.IDF,
+                                                index=models.SparseIndexParams(on_disk=self.on_disk))}
+
+    def hnsw_config(self, multitenant: bool = False) -> models.HnswConfigDiff:
+        if multitenant:
+            # Build HNSW links per tenant instead of one global graph; every search is tenant-filtered
+            return models.HnswConfigDiff(payload_m=self.hnsw_m, m=0, ef_construct=self.hnsw_ef_construct,
+                                         on_disk=self.hnsw_on_disk)
+        return models.HnswConfigDiff(m=self.hnsw_m, ef_construct=self.hnsw_ef_construct, on_disk=self.hnsw_on_disk)
+
+    def quantization_config(self) -> Optional[models.QuantizationConfig]:
+        # The quantized copies stay in RAM even when the original vectors are on disk
+        if self.quantization == "scalar":
+            return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8, quantile=0.99, always_ram=True))
+        if self.quantization == "binary":
+            return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+        return None
+
+    def collection_kwargs(self, vector_size: int, sparse_vector_name: str, multitenant: bool = False) -> dict:
+        """ create_collection arguments for a collection under this profile """
+        return {
+            "vectors_config": self.vectors_config(vector_size),
+            "sparse_vectors_config": self.sparse_vectors_config(sparse_vector_name),
+            "hnsw_config": self.hnsw_config(multitenant),
+            "quantization_config": self.quantization_config(),
+        }
+
+    def search_params(self, quantized: bool) -> Optional[models.SearchParams]:
+        """ Dense search parameters; rescoring only applies to collections that actually have quantized vectors """
+        quantization = None
+        if quantized:
+            quantization = models.QuantizationSearchParams(rescore=self.rescore, oversampling=self.oversampling)
+        if quantization is None and self.hnsw_ef is None:
+            return None
+        return models.SearchParams(hnsw_ef=self.hnsw_ef, quantization=quantization)
+
+    def matches(self, info: models.CollectionInfo, vector_size: int, multitenant: bool = False) -> bool:
+        """ Whether an existing collection already has this profile's settings """
+        vectors = info.config.params.vectors
+        vectors = vectors.get("") if isinstance(vectors, dict) else vectors
+        if vectors is None or vectors.size != vector_size or bool(vectors.on_disk) != self.on_disk:
+            return False
+        hnsw = info.config.hnsw_config
+        if multitenant:
+            graph_ok = hnsw.payload_m == self.hnsw_m and hnsw.m == 0
+        else:
+            graph_ok = hnsw.m == self.hnsw_m
+        if not graph_ok or hnsw.ef_construct != self.hnsw_ef_construct or bool(hnsw.on_disk) != self.hnsw_on_disk:
+            return False
+        current = info.config.quantization_config
+        if self.quantization == "scalar":
+            return isinstance(current, models.ScalarQuantization)
+        if self.quantization == "binary":
+            return isinstance(current, models.BinaryQuantization)
+        return current is None
+
+    def describe(self) -> dict:
+        return {
+            "name": self.name, "quantization": self.quantization, "on_disk": self.on_disk, "hnsw_m": self.hnsw_m,
+            "hnsw_ef_construct": self.hnsw_ef_construct, "hnsw_on_disk": self.hnsw_on_disk,
+            "rescore": self.rescore, "oversampling": self.oversampling, "hnsw_ef": self.hnsw_ef,
+        }
+
+
+def _env_bool(name: str) -> Optional[bool]:
+    value = os.getenv(name)
+    return None if value is None else value.lower() == "true"
+
+
+def load_profile() -> CollectionProfile:
+    """ The profile selected by QDRANT_PROFILE, with any of the QDRANT_* overrides applied """
+    name = os.getenv("QDRANT_PROFILE", "default").lower()
+    if name not in PROFILE_PRESETS:
+        raise ValueError(f"Unknown QDRANT_PROFILE {name!r}; expected one of {sorted(PROFILE_PRESETS)}")
+    settings = dict(PROFILE_PRESETS[name])
+    overrides = {
+        "quantization": os.getenv("QDRANT_QUANTIZATION"),
+        "on_disk": _env_bool("QDRANT_ON_DISK_VECTORS"),
+        "hnsw_m": os.getenv("QDRANT_HNSW_M"),
+        "hnsw_ef_construct": os.getenv("QDRANT_HNSW_EF_CONSTRUCT"),
+        "hnsw_on_disk": _env_bool("QDRANT_HNSW_ON_DISK"),
+        "rescore": _env_bool("QDRANT_RESCORE"),
+        "oversampling": os.getenv("QDRANT_OVERSAMPLING"),
+        "hnsw_ef": os.getenv("QDRANT_HNSW_EF"),
+    }
+    converters = {"hnsw_m": int, "hnsw_ef_construct": int, "oversampling": float, "hnsw_ef": int,
+                  "quantization": str.lower}
+    for key, value in overrides.items():
+        if value is not None:
+            settings[key] = converters[key](value) if key in converters else value
+    return CollectionProfile(name, **settings)
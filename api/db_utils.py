@@ -1,4 +1,10 @@
+import base64
+import json
+import os
+import queue
 import sqlite3
+import threading
+from contextlib import contextmanager
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 
@@ -6,44 +12,146 @@ DB_NAME = "rag_app.db"
 
 app = FastAPI()
 
+# Applied once per pooled connection. WAL lets readers run alongside a writer, and busy_timeout waits
+# for the write lock instead of failing with "database is locked".
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+class SQLiteConnectionPool:
+    """ Thread-safe pool of SQLite connections that are opened and configured once, then reused """
+
+    def __init__(self, path: str, size: int = 8):
+        self.path = path
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            finally:
+                # Never hand out a connection with a half-finished transaction
+                if conn.in_transaction:
+                    conn.rollback()
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+
+db_pool = SQLiteConnectionPool(DB_NAME, size=int(os.getenv("SQLITE_POOL_SIZE", "8")))
+
 
 def get_db_connection():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """ Borrow a pooled connection: `with get_db_connection() as conn:` """
+    return db_pool.connection()
 
 
 # --- Create Tables ---
+def _add_missing_columns(conn, table, columns):
+    """ Adds columns introduced after the table was first created """
+    existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for name, column_type in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+
 def create_tables():
-    conn = get_db_connection()
-
-    # Create organizations table
-    conn.execute('''CREATE TABLE IF NOT EXISTS organization (
-                        id TEXT PRIMARY KEY,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )''')
-
-    # Create workspaces table
-    conn.execute('''CREATE TABLE IF NOT EXISTS workspace (
-                        id TEXT PRIMARY KEY,
-                        organization_id TEXT NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (organization_id) REFERENCES organization(id) ON DELETE CASCADE
-                    )''')
-
-    # Create document store
-    conn.execute('''CREATE TABLE IF NOT EXISTS document_store (
-                        file_id TEXT PRIMARY KEY,
-                        filename TEXT,
-                        organization_id TEXT NOT NULL,
-                        workspace_id TEXT NOT NULL,
-                        upload_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (organization_id) REFERENCES organization(id) ON DELETE CASCADE,
-                        FOREIGN KEY (workspace_id) REFERENCES workspace(id) ON DELETE CASCADE
-                    )''')
-
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        # Create organizations table
+        conn.execute('''CREATE TABLE IF NOT EXISTS organization (
+                            id TEXT PRIMARY KEY,
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        )''')
+
+        # Create workspaces table
+        conn.execute('''CREATE TABLE IF NOT EXISTS workspace (
+                            id TEXT PRIMARY KEY,
+                            organization_id TEXT NOT NULL,
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                            FOREIGN KEY (organization_id) REFERENCES organization(id) ON DELETE CASCADE
+                        )''')
+
+        # Create document store
+        conn.execute('''CREATE TABLE IF NOT EXISTS document_store (
+                            file_id TEXT PRIMARY KEY,
+                            filename TEXT,
+                            organization_id TEXT NOT NULL,
+                            workspace_id TEXT NOT NULL,
+                            upload_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                            FOREIGN KEY (organization_id) REFERENCES organization(id) ON DELETE CASCADE,
+                            FOREIGN KEY (workspace_id) REFERENCES workspace(id) ON DELETE CASCADE
+                        )''')
+
+        # Create ingestion job queue (survives restarts)
+        conn.execute('''CREATE TABLE IF NOT EXISTS ingestion_job (
+                            id TEXT PRIMARY KEY,
+                            job_type TEXT NOT NULL,
+                            status TEXT NOT NULL DEFAULT 'queued',
+                            organization_id TEXT NOT NULL,
+                            workspace_id TEXT NOT NULL,
+                            file_id TEXT NOT NULL,
+                            payload TEXT,
+                            payload_path TEXT,
+                            attempts INTEGER NOT NULL DEFAULT 0,
+                            chunks_split INTEGER NOT NULL DEFAULT 0,
+                            chunks_embedded INTEGER NOT NULL DEFAULT 0,
+                            chunks_upserted INTEGER NOT NULL DEFAULT 0,
+                            error TEXT,
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        )''')
+
+        # Conversation memory: every turn, plus a running summary of the turns folded out of the window.
+        # A session belongs to the organization and workspace it was first used in.
+        conn.execute('''CREATE TABLE IF NOT EXISTS chat_session (
+                            session_id TEXT PRIMARY KEY,
+                            organization_id TEXT,
+                            workspace_id TEXT,
+                            summary TEXT NOT NULL DEFAULT '',
+                            summarized_through INTEGER NOT NULL DEFAULT 0,
+                            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        )''')
+        _add_missing_columns(conn, "chat_session", {"organization_id": "TEXT", "workspace_id": "TEXT"})
+        conn.execute('''CREATE TABLE IF NOT EXISTS chat_message (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            session_id TEXT NOT NULL,
+                            role TEXT NOT NULL,
+                            content TEXT NOT NULL,
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        )''')
+
+        # Indexes backing the filtered, newest-first listings and their keyset pagination
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_document_store_workspace
+                        ON document_store (organization_id, workspace_id, upload_timestamp DESC, file_id DESC)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_workspace_organization
+                        ON workspace (organization_id, created_at DESC, id DESC)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_organization_created
+                        ON organization (created_at DESC, id DESC)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_ingestion_job_status
+                        ON ingestion_job (status, created_at)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_chat_message_session
+                        ON chat_message (session_id, id)''')
+
+        conn.commit()
 
 
 create_tables()
@@ -52,119 +160,282 @@ create_tables()
 # --- Existing Functions ---
 def insert_document_record(file_id, filename, organization_id, workspace_id):
     """ Inserts a document record """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute(
-        'INSERT INTO document_store (file_id, filename, organization_id, workspace_id) VALUES (?, ?, ?, ?)',
-        (file_id, filename, organization_id, workspace_id)
-    )
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute(
+            'INSERT INTO document_store (file_id, filename, organization_id, workspace_id) VALUES (?, ?, ?, ?)',
+            (file_id, filename, organization_id, workspace_id)
+        )
+        conn.commit()
     return file_id
 
 
 def update_document_record(file_id, organization_id, workspace_id, new_filename):
     """ Updates the filename of a document """
-    conn = get_db_connection()
-    conn.execute(
-        'UPDATE document_store SET filename = ? WHERE file_id = ? AND organization_id = ? AND workspace_id = ?',
-        (new_filename, file_id, organization_id, workspace_id)
-    )
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        conn.execute(
+            'UPDATE document_store SET filename = ? WHERE file_id = ? AND organization_id = ? AND workspace_id = ?',
+            (new_filename, file_id, organization_id, workspace_id)
+        )
+        conn.commit()
     return True
 
 
 def delete_document_record(file_id, organization_id, workspace_id):
     """ Deletes a document record """
-    conn = get_db_connection()
-    conn.execute(
-        'DELETE FROM document_store WHERE file_id = ? AND organization_id = ? AND workspace_id = ?',
-        (file_id, organization_id, workspace_id)
-    )
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        conn.execute(
+            'DELETE FROM document_store WHERE file_id = ? AND organization_id = ? AND workspace_id = ?',
+            (file_id, organization_id, workspace_id)
+        )
+        conn.commit()
     return True
 
 
-def get_all_documents(organization_id, workspace_id):
-    """ Fetch all documents for a workspace """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''SELECT file_id, filename, organization_id, workspace_id, upload_timestamp 
-                      FROM document_store 
-                      WHERE organization_id = ? AND workspace_id = ? 
-                      ORDER BY upload_timestamp DESC''',
-                   (organization_id, workspace_id))
-    documents = cursor.fetchall()
-    conn.close()
-    return [dict(doc) for doc in documents]
+# --- Keyset Pagination ---
+def encode_cursor(*values):
+    """ Opaque cursor for the last row of a page (sort key + id) """
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return timestamp, row_id
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def _fetch_page(conn, query, params, cursor, limit, timestamp_column, id_column):
+    """ Runs a newest-first query one page at a time; returns (rows, next_cursor) """
+    if cursor:
+        query += f" AND ({timestamp_column}, {id_column}) < (?, ?)"
+        params = (*params, *decode_cursor(cursor))
+    query += f" ORDER BY {timestamp_column} DESC, {id_column} DESC LIMIT ?"
+    rows = [dict(row) for row in conn.execute(query, (*params, limit + 1)).fetchall()]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][timestamp_column], rows[-1][id_column])
+    return rows, next_cursor
+
+
+def get_documents_page(organization_id, workspace_id, limit=100, cursor=None):
+    """ Fetch one page of a workspace's documents, newest first """
+    with get_db_connection() as conn:
+        return _fetch_page(
+            conn,
+            '''SELECT file_id, filename, organization_id, workspace_id, upload_timestamp
+               FROM document_store
+               WHERE organization_id = ? AND workspace_id = ?''',
+            (organization_id, workspace_id), cursor, limit, "upload_timestamp", "file_id"
+        )
+
+
+def get_organizations_page(limit=100, cursor=None):
+    """ Fetch one page of organizations, newest first """
+    with get_db_connection() as conn:
+        return _fetch_page(conn, "SELECT id, created_at FROM organization WHERE 1 = 1", (), cursor, limit,
+                           "created_at", "id")
+
+
+def get_workspaces_page(organization_id, limit=100, cursor=None):
+    """ Fetch one page of an organization's workspaces, newest first """
+    with get_db_connection() as conn:
+        return _fetch_page(conn, "SELECT id, organization_id, created_at FROM workspace WHERE organization_id = ?",
+                           (organization_id,), cursor, limit, "created_at", "id")
 
 
 # --- Helper Functions ---
-def ensure_organization_exists(organization_id: str):
+def ensure_organization_exists(organization_id: str, conn=None):
     """ Ensure organization exists; insert if not exists """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    if conn is None:
+        with get_db_connection() as conn:
+            ensure_organization_exists(organization_id, conn)
+            conn.commit()
+        return
+    conn.execute("INSERT OR IGNORE INTO organization (id) VALUES (?)", (organization_id,))
 
-    cursor.execute("SELECT id FROM organization WHERE id = ?", (organization_id,))
-    if not cursor.fetchone():
-        cursor.execute("INSERT INTO organization (id) VALUES (?)", (organization_id,))
-        conn.commit()
 
-    conn.close()
+def ensure_workspace_exists(workspace_id: str, organization_id: str, conn=None):
+    """ Ensure workspace exists; insert if not exists """
+    if conn is None:
+        with get_db_connection() as conn:
+            ensure_workspace_exists(workspace_id, organization_id, conn)
+            conn.commit()
+        return
+    conn.execute("INSERT OR IGNORE INTO workspace (id, organization_id) VALUES (?, ?)", (workspace_id, organization_id))
 
 
-def ensure_workspace_exists(workspace_id: str, organization_id: str):
-    """ Ensure workspace exists; insert if not exists """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+# --- Insert Document with Auto-Ensure ---
+def insert_document(file_id: str, filename: str, organization_id: str, workspace_id: str):
+    """ Ensures organization and workspace exist, then inserts a document, all in one transaction """
+    with get_db_connection() as conn:
+        ensure_organization_exists(organization_id, conn)
+        ensure_workspace_exists(workspace_id, organization_id, conn)
+        conn.execute(
+            'INSERT INTO document_store (file_id, filename, organization_id, workspace_id) VALUES (?, ?, ?, ?)',
+            (file_id, filename, organization_id, workspace_id)
+        )
+        conn.commit()
+    return file_id
+
 
-    cursor.execute("SELECT id FROM workspace WHERE id = ?", (workspace_id,))
-    if not cursor.fetchone():
-        cursor.execute("INSERT INTO workspace (id, organization_id) VALUES (?, ?)", (workspace_id, organization_id))
+def insert_documents(documents):
+    """ Bulk version of insert_document: one transaction for many (file_id, filename, organization_id, workspace_id).
+    Returns the set of file_ids inserted; ids that already exist are skipped. """
+    inserted = set()
+    with get_db_connection() as conn:
+        conn.executemany("INSERT OR IGNORE INTO organization (id) VALUES (?)",
+                         {(organization_id,) for _, _, organization_id, _ in documents})
+        conn.executemany("INSERT OR IGNORE INTO workspace (id, organization_id) VALUES (?, ?)",
+                         {(workspace_id, organization_id) for _, _, organization_id, workspace_id in documents})
+        for document in documents:
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO document_store (file_id, filename, organization_id, workspace_id) VALUES (?, ?, ?, ?)',
+                document
+            )
+            if cursor.rowcount == 1:
+                inserted.add(document[0])
         conn.commit()
+    return inserted
 
-    conn.close()
 
+def delete_document_records(documents):
+    """ Deletes many (file_id, organization_id, workspace_id) records in one transaction """
+    with get_db_connection() as conn:
+        conn.executemany(
+            'DELETE FROM document_store WHERE file_id = ? AND organization_id = ? AND workspace_id = ?',
+            documents
+        )
+        conn.commit()
+    return True
 
-# --- Insert Document with Auto-Ensure ---
-def insert_document(file_id: str, filename: str, organization_id: str, workspace_id: str):
-    """ Ensures organization and workspace exist, then inserts a document """
-    # Ensure organization exists
-    ensure_organization_exists(organization_id)
 
-    # Ensure workspace exists
-    ensure_workspace_exists(workspace_id, organization_id)
+# --- Ingestion Jobs ---
+JOB_PROGRESS_COLUMNS = {"split": "chunks_split", "embedded": "chunks_embedded", "upserted": "chunks_upserted"}
 
-    # Insert document
-    return insert_document_record(file_id, filename, organization_id, workspace_id)
 
+def insert_ingestion_job(job_id, job_type, organization_id, workspace_id, file_id, payload=None, payload_path=None):
+    """ Records a queued ingestion job with its serialized request, inline or spilled to payload_path """
+    with get_db_connection() as conn:
+        conn.execute(
+            'INSERT INTO ingestion_job (id, job_type, organization_id, workspace_id, file_id, payload, payload_path) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (job_id, job_type, organization_id, workspace_id, file_id, payload, payload_path)
+        )
+        conn.commit()
+    return job_id
+
+
+def claim_ingestion_job(job_id):
+    """ Moves a queued job to running; returns False if another worker already took it """
+    with get_db_connection() as conn:
+        cursor = conn.execute(
+            """UPDATE ingestion_job SET status = 'running', attempts = attempts + 1,
+                      chunks_split = 0, chunks_embedded = 0, chunks_upserted = 0, updated_at = CURRENT_TIMESTAMP
+               WHERE id = ? AND status = 'queued'""",
+            (job_id,)
+        )
+        conn.commit()
+    return cursor.rowcount == 1
 
-def get_all_organizations():
-    """ Fetch all organizations """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, created_at FROM organization ORDER BY created_at DESC")
-    organizations = cursor.fetchall()
-    conn.close()
-    return [dict(org) for org in organizations]
 
-# --- Fetch All Workspaces for an Organization ---
-def get_all_workspaces(organization_id):
-    """ Fetch all workspaces under a specific organization """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, organization_id, created_at FROM workspace WHERE organization_id = ? ORDER BY created_at DESC", (organization_id,))
-    workspaces = cursor.fetchall()
-    conn.close()
-    return [dict(ws) for ws in workspaces]
+def increment_ingestion_job_progress(job_id, stage, count):
+    """ Adds count to the progress counter of a stage (split, embedded or upserted) """
+    column = JOB_PROGRESS_COLUMNS[stage]
+    with get_db_connection() as conn:
+        conn.execute(
+            f'UPDATE ingestion_job SET {column} = {column} + ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+            (count, job_id)
+        )
+        conn.commit()
 
 
+def finish_ingestion_job(job_id, status, error=None):
+    """ Marks a job completed or failed; the payload is no longer needed """
+    with get_db_connection() as conn:
+        conn.execute(
+            'UPDATE ingestion_job SET status = ?, error = ?, payload = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+            (status, error, job_id)
+        )
+        conn.commit()
 
 
+def get_ingestion_job(job_id):
+    """ Fetch a job, including its payload """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM ingestion_job WHERE id = ?", (job_id,))
+        job = cursor.fetchone()
+    return dict(job) if job else None
 
 
+def requeue_unfinished_ingestion_jobs():
+    """ Puts jobs interrupted by a restart back in the queue and returns their ids, oldest first """
+    with get_db_connection() as conn:
+        conn.execute("UPDATE ingestion_job SET status = 'queued' WHERE status = 'running'")
+        conn.commit()
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM ingestion_job WHERE status = 'queued' ORDER BY created_at")
+        job_ids = [row["id"] for row in cursor.fetchall()]
+    return job_ids
+
+
+def append_chat_messages(session_id, organization_id, workspace_id, messages):
+    """ Appends (role, content) messages to a session in one transaction. A new session (or one from before
+    sessions were scoped) is claimed for the tenant; returns False and appends nothing if another tenant owns it. """
+    with get_db_connection() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO chat_session (session_id, organization_id, workspace_id) VALUES (?, ?, ?)",
+            (session_id, organization_id, workspace_id)
+        )
+        conn.execute(
+            "UPDATE chat_session SET organization_id = ?, workspace_id = ? "
+            "WHERE session_id = ? AND organization_id IS NULL",
+            (organization_id, workspace_id, session_id)
+        )
+        session = conn.execute(
+            "SELECT organization_id, workspace_id FROM chat_session WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if (session["organization_id"], session["workspace_id"]) != (organization_id, workspace_id):
+            conn.rollback()
+            return False
+        conn.executemany(
+            "INSERT INTO chat_message (session_id, role, content) VALUES (?, ?, ?)",
+            [(session_id, role, content) for role, content in messages]
+        )
+        conn.execute("UPDATE chat_session SET updated_at = CURRENT_TIMESTAMP WHERE session_id = ?", (session_id,))
+        conn.commit()
+    return True
 
 
+def get_chat_session(session_id, organization_id, workspace_id):
+    """ Returns (summary, messages not yet folded into it), messages as dicts with id, role and content, oldest first.
+    A session owned by another tenant reads as empty. """
+    with get_db_connection() as conn:
+        session = conn.execute(
+            "SELECT summary, summarized_through FROM chat_session "
+            "WHERE session_id = ? AND organization_id = ? AND workspace_id = ?",
+            (session_id, organization_id, workspace_id)
+        ).fetchone()
+        if not session:
+            return "", []
+        messages = conn.execute(
+            "SELECT id, role, content FROM chat_message WHERE session_id = ? AND id > ? ORDER BY id",
+            (session_id, session["summarized_through"])
+        ).fetchall()
+    return session["summary"], [dict(message) for message in messages]
+
+
+def update_chat_summary(session_id, summary, summarized_through):
+    """ Stores the running summary covering every message up to and including summarized_through """
+    with get_db_connection() as conn:
+        conn.execute(
+            "UPDATE chat_session SET summary = ?, summarized_through = ?, updated_at = CURRENT_TIMESTAMP "
+            "WHERE session_id = ? AND summarized_through < ?",
+            (summary, summarized_through, session_id, summarized_through)
+        )
+        conn.commit()
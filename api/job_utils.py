@@ -0,0 +1,240 @@
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from pydantic_models import FileUpload, DeleteFileRequest
+from db_utils import insert_document, delete_document_record, update_document_record, insert_ingestion_job, \
+    claim_ingestion_job, increment_ingestion_job_progress, finish_ingestion_job, get_ingestion_job, \
+    requeue_unfinished_ingestion_jobs, insert_documents, delete_document_records
+from qdrant_utils import index_document_to_chroma, update_document_splits, prepare_splits, chunk_point_ids, \
+    add_splits, get_org_workspace_vectorstore, delete_doc_from_chroma
+from langchain_utils import invalidate_workspace
+from metrics_utils import stage
+
+# Uploads, updates and deletes run on this pool; per-backend limits live in qdrant_utils
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+
+# Payloads above this size are spilled to a uniquely named file instead of being kept in the job row
+INGEST_SPILL_BYTES = int(os.getenv("INGEST_SPILL_BYTES", str(8 * 1024 * 1024)))
+INGEST_SPILL_DIR = os.getenv("INGEST_SPILL_DIR") or None
+
+# Jobs for the same (organization_id, workspace_id, file_id) run one at a time, in submission order, so an
+# update never diffs against an upload that is still being written and a delete runs after both. Other files
+# run in parallel.
+_file_job_queues = {}
+_file_job_queues_lock = threading.Lock()
+# Set when a job submitted by a caller that waits for it (e.g. /delete-doc) has run
+_job_done_events = {}
+
+# Bulk uploads embed and upsert in much larger batches than single-document jobs
+BULK_EMBED_BATCH_SIZE = int(os.getenv("BULK_EMBED_BATCH_SIZE", "256"))
+
+
+def submit_ingestion_job(job_type: str, file: FileUpload) -> str:
+    """ Persist an upload/update job and hand it to the worker pool; returns the job id """
+    job_id = str(uuid.uuid4())
+    payload = file.model_dump_json()
+    if len(payload) > INGEST_SPILL_BYTES:
+        fd, payload_path = tempfile.mkstemp(prefix=f"ingest_{job_id}_", suffix=".json", dir=INGEST_SPILL_DIR)
+        with os.fdopen(fd, "w", encoding="utf-8") as spill_file:
+            spill_file.write(payload)
+        insert_ingestion_job(job_id, job_type, file.organization_id, file.workspace_id, file.file_id,
+                             payload_path=payload_path)
+    else:
+        insert_ingestion_job(job_id, job_type, file.organization_id, file.workspace_id, file.file_id,
+                             payload=payload)
+    _enqueue_job(job_id, (file.organization_id, file.workspace_id, file.file_id))
+    return job_id
+
+
+def submit_delete_job(request: DeleteFileRequest) -> str:
+    """ Queue a delete behind the file's pending uploads and updates; wait for it with wait_for_ingestion_job """
+    job_id = str(uuid.uuid4())
+    insert_ingestion_job(job_id, "delete", request.organization_id, request.workspace_id, request.file_id)
+    with _file_job_queues_lock:
+        _job_done_events[job_id] = threading.Event()
+    _enqueue_job(job_id, (request.organization_id, request.workspace_id, request.file_id))
+    return job_id
+
+
+def wait_for_ingestion_job(job_id: str, timeout: float) -> bool:
+    """ Whether a job from submit_delete_job has run within timeout seconds """
+    with _file_job_queues_lock:
+        event = _job_done_events.get(job_id)
+    return event is None or event.wait(timeout)
+
+
+def _enqueue_job(job_id: str, file_key: tuple):
+    with _file_job_queues_lock:
+        queue = _file_job_queues.setdefault(file_key, deque())
+        queue.append(job_id)
+        if len(queue) > 1:
+            # A worker is already running this file's jobs and will pick this one up
+            return
+    executor.submit(_run_file_jobs, file_key)
+
+
+def _run_file_jobs(file_key: tuple):
+    """ Run the queued jobs of one file in order until its queue is empty """
+    while True:
+        with _file_job_queues_lock:
+            job_id = _file_job_queues[file_key][0]
+        try:
+            run_ingestion_job(job_id)
+        finally:
+            with _file_job_queues_lock:
+                done = _job_done_events.pop(job_id, None)
+                if done:
+                    done.set()
+                queue = _file_job_queues[file_key]
+                queue.popleft()
+                if not queue:
+                    del _file_job_queues[file_key]
+                    return
+
+
+def resume_ingestion_jobs():
+    """ Re-submit jobs that were queued or running when the process stopped """
+    job_ids = requeue_unfinished_ingestion_jobs()
+    for job_id in job_ids:
+        job = get_ingestion_job(job_id)
+        _enqueue_job(job_id, (job["organization_id"], job["workspace_id"], job["file_id"]))
+    if job_ids:
+        logging.info(f"Resumed {len(job_ids)} ingestion jobs")
+
+
+def shutdown_ingestion_workers():
+    # Queued jobs stay 'queued' in the database and are resumed on the next start
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def run_ingestion_job(job_id: str):
+    if not claim_ingestion_job(job_id):
+        return
+    job = None
+
+    def progress(stage, count):
+        increment_ingestion_job_progress(job_id, stage, count)
+
+    try:
+        # Inside the try so a missing spill file or an invalid payload fails the job instead of leaving it running
+        job = get_ingestion_job(job_id)
+        file = _load_payload(job) if job["job_type"] != "delete" else None
+        with stage("ingestion_job", organization_id=job["organization_id"], workspace_id=job["workspace_id"],
+                   job_id=job_id, job_type=job["job_type"]):
+            if job["job_type"] == "upload":
+                _run_upload(job, file, progress)
+            elif job["job_type"] == "delete":
+                _run_delete(job)
+            else:
+                _run_update(job, file, progress)
+        finish_ingestion_job(job_id, "completed")
+    except Exception as e:
+        logging.exception(f"Ingestion job {job_id} failed")
+        finish_ingestion_job(job_id, "failed", str(e))
+    finally:
+        if job is not None:
+            invalidate_workspace(job["organization_id"], job["workspace_id"])
+            if job["payload_path"] and os.path.exists(job["payload_path"]):
+                os.remove(job["payload_path"])
+
+
+def _load_payload(job) -> FileUpload:
+    if job["payload_path"]:
+        with open(job["payload_path"], "r", encoding="utf-8") as spill_file:
+            return FileUpload.model_validate_json(spill_file.read())
+    return FileUpload.model_validate_json(job["payload"])
+
+
+def _run_upload(job, file: FileUpload, progress):
+    try:
+        # Insert the document record into the database
+        insert_document(
+            file_id=file.file_id,
+            filename=file.filename,
+            organization_id=file.organization_id,
+            workspace_id=file.workspace_id
+        )
+    except sqlite3.IntegrityError:
+        # A resumed job may already have inserted its record before the restart
+        if job["attempts"] <= 1:
+            raise
+
+    success = index_document_to_chroma(file, file.organization_id, file.workspace_id, file.file_id, progress)
+    if not success:
+        delete_document_record(file.file_id, file.organization_id, file.workspace_id)
+        raise RuntimeError("Failed to index JSON data.")
+
+
+def _run_update(job, file: FileUpload, progress):
+    success = update_document_splits(file, file.organization_id, file.workspace_id, file.file_id, progress)
+    if not success:
+        # The previous version is still indexed, so keep its record
+        raise RuntimeError(f"Failed to index {file.filename}.")
+    update_document_record(file.file_id, file.organization_id, file.workspace_id, file.filename)
+
+
+def _run_delete(job):
+    if not delete_doc_from_chroma(job["organization_id"], job["workspace_id"], job["file_id"]):
+        raise RuntimeError(f"Failed to delete document with file_id {job['file_id']} from Chroma.")
+    if not delete_document_record(job["file_id"], job["organization_id"], job["workspace_id"]):
+        raise RuntimeError(f"Deleted from Chroma but failed to delete document with file_id {job['file_id']} "
+                           f"from the database.")
+
+
+def index_documents_bulk(files: List[FileUpload]) -> List[dict]:
+    """ Index many documents at once: all document_store rows in one transaction, then one large
+    embed-and-upsert pass per workspace. Returns one result per file, in request order. """
+    results = [{"file_id": file.file_id, "status": "failed", "error": None, "chunks": 0} for file in files]
+    inserted = insert_documents([(file.file_id, file.filename, file.organization_id, file.workspace_id) for file in files])
+    claimed, owned = set(), []
+
+    # Split everything first, grouped by the workspace collection it goes to
+    workspaces = {}
+    for result, file in zip(results, files):
+        if file.file_id not in inserted or file.file_id in claimed:
+            result["error"] = "A document with this file_id already exists."
+            continue
+        claimed.add(file.file_id)
+        owned.append((result, file))
+        try:
+            splits = prepare_splits(file, file.file_id)
+            if not splits:
+                raise ValueError("No splits returned from the document loader.")
+        except Exception as e:
+            result["error"] = f"Failed to split document: {e}"
+            continue
+        workspaces.setdefault((file.organization_id, file.workspace_id), []).append((result, file, splits))
+
+    for (organization_id, workspace_id), entries in workspaces.items():
+        splits, ids = [], []
+        try:
+            vectorstore = get_org_workspace_vectorstore(organization_id, workspace_id)
+            for _, file, file_splits in entries:
+                splits.extend(file_splits)
+                ids.extend(chunk_point_ids(file.file_id, file_splits, vectorstore.tenant))
+            stats = add_splits(vectorstore, splits, ids, batch_size=BULK_EMBED_BATCH_SIZE)
+            logging.info(f"Bulk indexed {len(entries)} documents into org {organization_id} workspace {workspace_id}: "
+                         f"{len(splits)} splits, {stats['chunks_per_second']:.1f} chunks/s")
+            for result, _, file_splits in entries:
+                result.update(status="indexed", chunks=len(file_splits))
+        except Exception as e:
+            logging.exception(f"Bulk indexing failed for org {organization_id} workspace {workspace_id}")
+            for result, _, _ in entries:
+                result["error"] = f"Failed to index JSON data: {e}"
+        finally:
+            invalidate_workspace(organization_id, workspace_id)
+
+    # Drop the records of documents that were inserted but could not be indexed
+    failed_records = [(file.file_id, file.organization_id, file.workspace_id)
+                      for result, file in owned if result["status"] == "failed"]
+    if failed_records:
+        delete_document_records(failed_records)
+    return results
@@ -1,14 +1,19 @@
 from langchain_ollama import ChatOllama
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
-from langchain.chains import create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from qdrant_utils import get_org_workspace_vectorstore
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from qdrant_utils import get_org_workspace_vectorstore, invalidate_workspace_vectorstore
+from cache_utils import LRUTTLCache, SemanticAnswerCache
+from rerank_utils import get_reranker, RERANK_CANDIDATES
+from prompt_utils import PromptBuilder, count_tokens, estimate_tokens
+from metrics_utils import stage, observe_stage, tenant, RETRIEVED_CHUNKS, GENERATION_TOKENS_PER_SECOND
 from langchain_core.vectorstores import VectorStoreRetriever
 from typing import Any, Dict, List
 from pydantic import Field
 from langchain.schema import Document
+import asyncio
 import json
+import os
+import time
 from pydantic import BaseModel, Field,validator
 from typing import List
 
@@ -62,20 +67,72 @@ Filename:
 
 """),
     ("system", "context: {context}  "),
+    MessagesPlaceholder("history", optional=True),
     ("human", "{input}")
 ])
 
 
 
-def get_rag_chain(query, organization_id: str, workspace_id: str, model: str = "llama3.2", k: int = 3, file_id: str | None = None):
+# --- Pipeline registry ---
+# Ready-to-use pipelines keyed by (organization_id, workspace_id, model, k, file_id),
+# so a hot tenant does not rebuild the vectorstore, LLM client and chains on every question.
+pipeline_registry = LRUTTLCache(
+    maxsize=int(os.getenv("PIPELINE_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("PIPELINE_CACHE_TTL", "600")),
+)
+llm_cache = LRUTTLCache(maxsize=16, ttl=float(os.getenv("PIPELINE_CACHE_TTL", "600")))
+
+# Answers to near-identical questions, keyed by (organization_id, workspace_id, file_id, model)
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+answer_cache = SemanticAnswerCache(
+    threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95")),
+    max_buckets=int(os.getenv("SEMANTIC_CACHE_BUCKETS", "256")),
+    max_entries_per_bucket=int(os.getenv("SEMANTIC_CACHE_ENTRIES", "256")),
+    ttl=float(os.getenv("SEMANTIC_CACHE_TTL", "3600")),
+)
+
+
+# Chunks retrieved per question when no reranker is configured
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "3"))
+
+# Merge dense and BM25 results with reciprocal rank fusion; collections without BM25 vectors stay dense-only
+HYBRID_RETRIEVAL = os.getenv("HYBRID_RETRIEVAL", "false").lower() == "true"
+
+
+def get_llm(model: str):
+    return llm_cache.get_or_create(model, lambda: ChatOllama(model=model))
+
+
+def invalidate_workspace(organization_id: str, workspace_id: str):
+    """ Drop cached pipelines, answers and the vectorstore of a workspace whose documents changed """
+    pipeline_registry.invalidate(lambda key: key[:2] == (organization_id, workspace_id))
+    answer_cache.invalidate_workspace(organization_id, workspace_id)
+    invalidate_workspace_vectorstore(organization_id, workspace_id)
+
+
+async def aget_rag_chain(query, organization_id: str, workspace_id: str, model: str = "llama3.2", k: int = RAG_TOP_K, file_id: str | None = None):
+    """ The cached RagPipeline for a workspace, model and file scope; a registry miss builds it off the event loop """
     if not (organization_id and workspace_id):
         raise ValueError("Both organization_id and workspace_id are required.")
 
+    key = (organization_id, workspace_id, model, k, file_id)
+    pipeline = pipeline_registry.get(key)
+    if pipeline is None:
+        pipeline = await asyncio.to_thread(build_rag_chain, organization_id, workspace_id, model, k, file_id)
+        pipeline_registry.set(key, pipeline)
+    return pipeline
+
+
+def build_rag_chain(organization_id: str, workspace_id: str, model: str, k: int, file_id: str | None):
     # Initialize the language model
-    llm = ChatOllama(model=model)
+    llm = get_llm(model)
     workspace_vectorstore = get_org_workspace_vectorstore(organization_id, workspace_id)
 
-    search_kwargs = {"k": k}
+    # With a reranker, over-fetch candidates; the reranker then fills the context up to its token budget
+    reranker = get_reranker()
+    search_kwargs = {"k": max(k, RERANK_CANDIDATES) if reranker else k}
+    if HYBRID_RETRIEVAL:
+        search_kwargs["hybrid"] = True
     retriever = workspace_vectorstore.as_retriever(search_kwargs=search_kwargs)
 
     # If file_id is provided, filter the vectorstore using metadata
@@ -83,42 +140,94 @@ def get_rag_chain(query, organization_id: str, workspace_id: str, model: str = "
         retriever = FilteredVectorStoreRetrieverWithFilter(
             vectorstore=workspace_vectorstore,
             search_kwargs=search_kwargs,
-            metadata_filter={"metadata.template_id": int(file_id)},
+            metadata_filter={"metadata.file_id": file_id},
             search_type=retriever.search_type  # carry over any search configuration
         )
 
-    # Helper: format each retrieved document with its metadata (template_id and filename)
-    def format_documents_with_metadata(docs):
-        formatted_docs = []
-        for i, doc in enumerate(docs):
-            template_id = doc.metadata.get("template_id", "N/A")
-            filename = doc.metadata.get("filename", "N/A")
-            # You can decide whether to use the full content or just a snippet
-            content = doc.page_content
-            formatted_docs.append(
-                f"Document {i}:\n"
-                f"\"template_id\": \"{template_id}\"\n"
-                f"\"filename\": \"{filename}\"\n"
-                f"\"content\": \"{content}\"\n"
-            )
-        return "\n".join(formatted_docs)
-
-
-    # Create the question-answer chain with the custom prompt
-    question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
-
-    # Create the retrieval chain that combines the retriever and QA chain.
-    rag_chain = create_retrieval_chain(retriever, question_answer_chain)
+    # The context is assembled by the prompt builder, so the chain is just prompt -> LLM -> text
+    question_answer_chain = qa_prompt | llm | output_parser
+    prompt_builder = PromptBuilder(model, fixed_tokens=count_tokens(qa_prompt.format(context="", input=""), model))
+
+    return RagPipeline(retriever, question_answer_chain, reranker, organization_id, workspace_id, model,
+                       prompt_builder)
+
+
+class RagPipeline:
+    """ Retrieve once, fit the documents into the prompt's token budget, then run the question-answer chain.
+    (create_retrieval_chain would run the retriever a second time on the formatted context.) """
+
+    def __init__(self, retriever, question_answer_chain, reranker=None, organization_id=None, workspace_id=None,
+                 model=None, prompt_builder=None):
+        self.retriever = retriever
+        self.question_answer_chain = question_answer_chain
+        self.reranker = reranker
+        self.model = model
+        self.prompt_builder = prompt_builder or PromptBuilder(model)
+        # Tenant labels for the per-stage spans and metrics
+        self.labels = {"organization_id": organization_id, "workspace_id": workspace_id}
+
+    def _chain_input(self, input_dict, docs, timings):
+        """ Prompt variables, with each chunk in the context once, and the documents that made it in """
+        history = input_dict.get("history", [])
+        with stage("prompt_build", timings, **self.labels) as span:
+            context, used_docs, context_tokens = self.prompt_builder.build_context(docs, input_dict["input"], history)
+            span.set_attribute("chunks", len(used_docs))
+            span.set_attribute("context_tokens", context_tokens)
+        return {"input": input_dict["input"], "context": context, "history": history}, used_docs
+
+    async def _aretrieve(self, input_dict):
+        # Reuse the question embedding when the caller already computed it (e.g. for the answer cache)
+        embedding = input_dict.get("embedding")
+        if embedding is None:
+            return await self.retriever.ainvoke(input_dict["input"])
+        search_kwargs = dict(self.retriever.search_kwargs)
+        if isinstance(self.retriever, FilteredVectorStoreRetrieverWithFilter):
+            search_kwargs["filter"] = self.retriever._build_qdrant_filter(self.retriever.metadata_filter)
+        return await self.retriever.vectorstore.asimilarity_search_by_vector(
+            embedding, query=input_dict["input"], **search_kwargs
+        )
 
-    # (Optional) You might want to wrap rag_chain.invoke so that it first formats the retrieved documents.
-    # For example:
-    def invoke_chain(input_dict):
-        # First, use the retriever to get a list of documents
-        docs = retriever.invoke(input_dict["input"])
-        # Format the retrieved docs with metadata
-        formatted_context = format_documents_with_metadata(docs)
-        # Now, add the formatted context to the input and invoke the chain
-        return rag_chain.invoke({"input":formatted_context+input_dict["input"]})
+    async def _aretrieve_and_rerank(self, input_dict, timings):
+        with stage("retrieval", timings, **self.labels) as span:
+            docs = await self._aretrieve(input_dict)
+            span.set_attribute("chunks", len(docs))
+        RETRIEVED_CHUNKS.labels(**tenant(**self.labels)).observe(len(docs))
+        if self.reranker:
+            # The cross-encoder is CPU-bound, keep it off the event loop
+            with stage("rerank", timings, **self.labels):
+                docs = await asyncio.to_thread(self.reranker.rerank, input_dict["input"], docs)
+        return docs
+
+    def _observe_generation(self, answer, timings):
+        if timings.get("generation"):
+            GENERATION_TOKENS_PER_SECOND.labels(model=self.model or "", **tenant(**self.labels)).observe(
+                estimate_tokens(answer) / timings["generation"]
+            )
 
-    # Return the modified chain (or a wrapped function) that now uses the formatted context
-    return invoke_chain
+    async def ainvoke(self, input_dict):
+        timings = {}
+        docs = await self._aretrieve_and_rerank(input_dict, timings)
+
+        chain_input, docs = self._chain_input(input_dict, docs, timings)
+        with stage("generation", timings, **self.labels):
+            answer = await self.question_answer_chain.ainvoke(chain_input)
+        self._observe_generation(answer, timings)
+
+        return {"input": input_dict["input"], "context": docs, "answer": answer, "timings": timings}
+
+    async def astream(self, input_dict, timings=None):
+        """ Retrieve, then yield answer chunks as the LLM produces them """
+        timings = timings if timings is not None else {}
+        docs = await self._aretrieve_and_rerank(input_dict, timings)
+
+        chain_input, docs = self._chain_input(input_dict, docs, timings)
+        chunks = []
+        with stage("generation", timings, **self.labels):
+            start = time.perf_counter()
+            async for chunk in self.question_answer_chain.astream(chain_input):
+                if "first_token" not in timings:
+                    timings["first_token"] = time.perf_counter() - start
+                    observe_stage("first_token", timings["first_token"], **self.labels)
+                chunks.append(chunk)
+                yield chunk
+        self._observe_generation("".join(chunks), timings)
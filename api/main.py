@@ -1,153 +1,350 @@
+import asyncio
 import json
 import time
-from fastapi import FastAPI
+from fastapi import FastAPI, Query, Request, Response
+from pydantic import ValidationError
 from pydantic_models import QueryInput, QueryResponse, DocumentInfo, DeleteFileRequest, ListDoc, FileUpload, ListDoc, \
-    FileRecord
-from langchain_utils import get_rag_chain
-from db_utils import get_all_documents, insert_document, \
-    delete_document_record, update_document_record, get_all_organizations, get_all_workspaces
-from qdrant_utils import index_document_to_chroma, delete_doc_from_chroma, update_document_splits
+    FileRecord, JobInfo
+from langchain_utils import aget_rag_chain, invalidate_workspace, answer_cache, pipeline_registry, get_llm, \
+    SEMANTIC_CACHE_ENABLED
+from memory_utils import load_history, condense_question, save_turn, schedule_summary, CHAT_MEMORY_ENABLED
+from db_utils import get_documents_page, insert_document, get_organizations_page, get_workspaces_page, \
+    get_ingestion_job
+from qdrant_utils import embedding_function, vectorstore_cache
+from job_utils import submit_ingestion_job, resume_ingestion_jobs, shutdown_ingestion_workers, index_documents_bulk, \
+    submit_delete_job, wait_for_ingestion_job
+from stream_utils import ThinkTagFilter, ReleasingStreamingResponse, format_sse
+from metrics_utils import RequestTrace, stage, observe_stage, latest_metrics
 import uuid
 import logging
 from fastapi import UploadFile, File, HTTPException
 import os
 import shutil
-logging.basicConfig(filename='app.log', level=logging.INFO)
-app = FastAPI()
+from contextlib import asynccontextmanager
+from logging_utils import setup_logging, stop_logging
+from prompt_utils import is_estimated, TOKEN_ESTIMATE_MARGIN
+setup_logging()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Pick up ingestion jobs that were queued or running when the process last stopped
+    resume_ingestion_jobs()
+    if is_estimated():
+        logging.warning(f"Prompt tokens are estimated, not counted (install tiktoken); {TOKEN_ESTIMATE_MARGIN:.0%} "
+                        f"of the context window is held back")
+    yield
+    shutdown_ingestion_workers()
+    stop_logging()
+
+
+app = FastAPI(lifespan=lifespan)
 import re
 
 def remove_think_tags(text):
     cleaned_text = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL)
     return cleaned_text.strip()
 
+# Bound concurrent chats so a burst queues here instead of piling onto Ollama/Qdrant
+CHAT_MAX_CONCURRENCY = int(os.getenv("CHAT_MAX_CONCURRENCY", "32"))
+CHAT_QUEUE_TIMEOUT = float(os.getenv("CHAT_QUEUE_TIMEOUT", "30"))
+chat_limiter = asyncio.Semaphore(CHAT_MAX_CONCURRENCY)
+
+# /delete-doc waits this long for the delete to run behind the file's pending ingestion jobs
+DELETE_WAIT_SECONDS = float(os.getenv("DELETE_WAIT_SECONDS", "30"))
+
+async def lookup_cached_answer(query_input: QueryInput, question: str, history):
+    """ Embed the question and look it up in the semantic answer cache.
+    Returns (cache_key, embedding, generation, answer); answer is None on a miss. Turns with conversation
+    history skip the cache both ways: their answers also depend on the history, which the key does not cover. """
+    if not SEMANTIC_CACHE_ENABLED or history:
+        return None, None, None, None
+    labels = {"organization_id": query_input.organization_id, "workspace_id": query_input.workspace_id}
+    cache_key = (query_input.organization_id, query_input.workspace_id, query_input.file_id or None,
+                 query_input.model.value)
+    generation = answer_cache.generation(query_input.organization_id, query_input.workspace_id)
+    with stage("embed_query", **labels):
+        embedding = await embedding_function.aembed_query(question)
+    with stage("cache_lookup", **labels) as span:
+        answer = answer_cache.lookup(cache_key, embedding)
+        span.set_attribute("hit", answer is not None)
+    return cache_key, embedding, generation, answer
+
+async def prepare_question(query_input: QueryInput, session_id: str):
+    """ Returns (history, question): the session's prompt history and the follow-up rewritten as a standalone
+    question, which is what retrieval and the answer cache see """
+    if not (CHAT_MEMORY_ENABLED and query_input.session_id):
+        return [], query_input.question
+    with stage("condense", organization_id=query_input.organization_id, workspace_id=query_input.workspace_id):
+        history = await load_history(session_id, query_input.organization_id, query_input.workspace_id)
+        question = await condense_question(get_llm(query_input.model.value), history, query_input.question)
+    if question != query_input.question:
+        logging.info(f"Session ID: {session_id}, Standalone question: {question}")
+    return history, question
+
+async def remember_turn(query_input: QueryInput, session_id: str, answer: str):
+    if CHAT_MEMORY_ENABLED:
+        if await save_turn(session_id, query_input.organization_id, query_input.workspace_id,
+                           query_input.question, answer):
+            schedule_summary(get_llm(query_input.model.value), session_id,
+                             query_input.organization_id, query_input.workspace_id)
+
 @app.post("/chat", response_model=QueryResponse)
-def chat(query_input: QueryInput):
+async def chat(query_input: QueryInput):
     session_id = query_input.session_id
     logging.info(f"Session ID: {session_id}, User Query: {query_input.question}, Model: {query_input.model.value}")
     if not session_id:
         session_id = str(uuid.uuid4())
+    labels = {"organization_id": query_input.organization_id, "workspace_id": query_input.workspace_id}
+    request_trace = RequestTrace("/chat", **labels, model=query_input.model.value)
 
-    
-
-    if query_input.file_id:
-        rag_chain = get_rag_chain(
-            query=query_input.question,
-            organization_id=query_input.organization_id,
-            workspace_id=query_input.workspace_id,
-            file_id=query_input.file_id,
-            model=query_input.model.value
-        )
-    else:
-        rag_chain = get_rag_chain(
-            query=query_input.question,
-            organization_id=query_input.organization_id,
-            workspace_id=query_input.workspace_id,
-            model=query_input.model.value,
-            file_id=None
-        )
-
-    answer = rag_chain({
-        "input": query_input.question,
-    })
-    answer=answer["answer"]
-    answer = remove_think_tags(answer)
+    try:
+        with request_trace.activate():
+            try:
+                with stage("queue_wait", **labels):
+                    await asyncio.wait_for(chat_limiter.acquire(), timeout=CHAT_QUEUE_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=503, detail="Too many concurrent chat requests, please retry later.")
+
+            try:
+                history, question = await prepare_question(query_input, session_id)
+                cache_key, embedding, generation, cached_answer = await lookup_cached_answer(query_input, question, history)
+                if cached_answer is not None:
+                    logging.info(f"Session ID: {session_id}, answered from semantic cache")
+                    await remember_turn(query_input, session_id, cached_answer)
+                    return QueryResponse(answer=cached_answer, session_id=session_id, model=query_input.model)
+
+                rag_chain = await aget_rag_chain(
+                    query=query_input.question,
+                    organization_id=query_input.organization_id,
+                    workspace_id=query_input.workspace_id,
+                    model=query_input.model.value,
+                    file_id=query_input.file_id or None
+                )
+
+                answer = await rag_chain.ainvoke({
+                    "input": question,
+                    "embedding": embedding,
+                    "history": history,
+                })
+            finally:
+                chat_limiter.release()
+
+            timings = answer["timings"]
+            answer=answer["answer"]
+            with stage("think_strip", **labels):
+                answer = remove_think_tags(answer)
+            if cache_key:
+                answer_cache.store(cache_key, question, embedding, answer, generation)
+            await remember_turn(query_input, session_id, answer)
+    finally:
+        request_trace.end()
 
+    logging.info(f"Session ID: {session_id}, Retrieval: {timings['retrieval']:.3f}s, Rerank: {timings.get('rerank', 0.0):.3f}s, "
+                 f"Generation: {timings['generation']:.3f}s")
     logging.info(f"Session ID: {session_id}, AI Response: {answer}")
     return QueryResponse(answer=answer, session_id=session_id, model=query_input.model)
 
 
+@app.post("/chat/stream")
+async def chat_stream(query_input: QueryInput):
+    """ Same as /chat, but sends the answer as Server-Sent Events while it is generated """
+    session_id = query_input.session_id
+    logging.info(f"Session ID: {session_id}, User Query: {query_input.question}, Model: {query_input.model.value}")
+    if not session_id:
+        session_id = str(uuid.uuid4())
+    labels = {"organization_id": query_input.organization_id, "workspace_id": query_input.workspace_id}
+    # The request span stays open until the last event has been sent
+    request_trace = RequestTrace("/chat/stream", **labels, model=query_input.model.value)
+    slot_held = False
+
+    def release():
+        """ Give back the chat slot and close the request span; safe to call more than once """
+        nonlocal slot_held
+        if slot_held:
+            slot_held = False
+            chat_limiter.release()
+        request_trace.end()
+
+    with request_trace.activate():
+        try:
+            with stage("queue_wait", **labels):
+                await asyncio.wait_for(chat_limiter.acquire(), timeout=CHAT_QUEUE_TIMEOUT)
+            slot_held = True
+        except asyncio.TimeoutError:
+            request_trace.end()
+            raise HTTPException(status_code=503, detail="Too many concurrent chat requests, please retry later.")
+
+        try:
+            history, question = await prepare_question(query_input, session_id)
+            cache_key, embedding, generation, cached_answer = await lookup_cached_answer(query_input, question, history)
+            rag_chain = None
+            if cached_answer is None:
+                rag_chain = await aget_rag_chain(
+                    query=query_input.question,
+                    organization_id=query_input.organization_id,
+                    workspace_id=query_input.workspace_id,
+                    model=query_input.model.value,
+                    file_id=query_input.file_id or None
+                )
+        except Exception:
+            release()
+            raise
+
+    async def cached_stream():
+        try:
+            logging.info(f"Session ID: {session_id}, answered from semantic cache")
+            yield format_sse("token", {"token": cached_answer})
+            yield format_sse("done", {"session_id": session_id, "model": query_input.model.value, "cached": True})
+        finally:
+            release()
+        await remember_turn(query_input, session_id, cached_answer)
+
+    async def event_stream():
+        timings = {}
+        think_filter = ThinkTagFilter()
+        think_seconds = 0.0
+        answer_parts = []
+        try:
+            with request_trace.activate():
+                async for chunk in rag_chain.astream({"input": question, "embedding": embedding, "history": history},
+                                                     timings):
+                    start = time.perf_counter()
+                    text = think_filter.feed(chunk)
+                    think_seconds += time.perf_counter() - start
+                    if text:
+                        answer_parts.append(text)
+                        yield format_sse("token", {"token": text})
+                text = think_filter.flush()
+                if text:
+                    answer_parts.append(text)
+                    yield format_sse("token", {"token": text})
+                observe_stage("think_strip", think_seconds, **labels)
+            yield format_sse("done", {"session_id": session_id, "model": query_input.model.value})
+        except Exception as e:
+            logging.exception(f"Session ID: {session_id}, streaming failed")
+            yield format_sse("error", {"detail": str(e)})
+            return
+        finally:
+            release()
+
+        logging.info(f"Session ID: {session_id}, Retrieval: {timings['retrieval']:.3f}s, "
+                     f"Rerank: {timings.get('rerank', 0.0):.3f}s, First token: {timings.get('first_token', 0.0):.3f}s, Generation: {timings['generation']:.3f}s")
+        answer = "".join(answer_parts).strip()
+        if cache_key:
+            answer_cache.store(cache_key, question, embedding, answer, generation)
+        await remember_turn(query_input, session_id, answer)
+        logging.info(f"Session ID: {session_id}, AI Response: {answer}")
+
+    # The response releases the slot too, in case the body is never iterated
+    return ReleasingStreamingResponse(
+        cached_stream() if cached_answer is not None else event_stream(),
+        on_close=release,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.post("/upload-doc")
 def upload_and_index_document(file: FileUpload):
-    temp_file_path = f"temp_{file.organization_id}_{file.workspace_id}.json"
-
+    """ Queue a document for indexing; poll /jobs/{job_id} for progress """
+    # Ensure required attributes exist
+    if not file.organization_id or not file.workspace_id or not file.file:
+        raise HTTPException(status_code=400, detail="Missing required JSON fields.")
+
+    job_id = submit_ingestion_job("upload", file)
+    return {
+        "message": "JSON data has been queued for indexing.",
+        "file_id": file.file_id,
+        "job_id": job_id
+    }
+
+@app.post("/upload-docs/bulk")
+async def upload_documents_bulk(request: Request):
+    """ Index many documents in one request. The body is a JSON list of FileUpload objects,
+    or one FileUpload per line when sent as application/x-ndjson. Reports success or failure per file. """
+    body = await request.body()
     try:
-        # Ensure required attributes exist
+        if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+            items = [json.loads(line) for line in body.decode("utf-8").splitlines() if line.strip()]
+        else:
+            items = json.loads(body)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid request body: {e}")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Expected a list of documents.")
+
+    results = [None] * len(items)
+    files, positions = [], []
+    for index, item in enumerate(items):
+        try:
+            file = FileUpload.model_validate(item)
+        except ValidationError as e:
+            results[index] = {"index": index, "file_id": item.get("file_id") if isinstance(item, dict) else None,
+                              "status": "failed", "error": str(e), "chunks": 0}
+            continue
         if not file.organization_id or not file.workspace_id or not file.file:
-            raise HTTPException(status_code=400, detail="Missing required JSON fields.")
-
-
+            results[index] = {"index": index, "file_id": file.file_id, "status": "failed",
+                              "error": "Missing required JSON fields.", "chunks": 0}
+            continue
+        files.append(file)
+        positions.append(index)
 
-        with open(temp_file_path, "w", encoding="utf-8") as json_file:
-            json.dump(file.model_dump(), json_file, ensure_ascii=False, indent=4)
-        # Insert the document record into the database
-        file_id = insert_document(
-            file_id=file.file_id,
-            filename=temp_file_path,  # Store the temp file name as filename
-            organization_id=file.organization_id,
-            workspace_id=file.workspace_id
-        )
+    if files:
+        for index, result in zip(positions, await asyncio.to_thread(index_documents_bulk, files)):
+            results[index] = {"index": index, **result}
 
-        # Index the document in ChromaDB (modify this function to read JSON if needed)
-        success = index_document_to_chroma(temp_file_path, file.organization_id, file.workspace_id, file.file_id)
+    indexed = sum(1 for result in results if result["status"] == "indexed")
+    logging.info(f"Bulk upload: {indexed} of {len(results)} documents indexed")
+    return {"results": results, "indexed": indexed, "failed": len(results) - indexed}
 
-        if not success:
-            delete_document_record(file_id, file.organization_id, file.workspace_id)
-            raise HTTPException(status_code=500, detail="Failed to index JSON data.")
+# Listings are paginated by keyset: pass the X-Next-Cursor header of one page as ?cursor= to get the next
+def _set_next_cursor(response: Response, next_cursor):
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
 
-        return {
-            "message": "JSON data has been successfully uploaded and indexed.",
-            "file_id": file_id
-        }
-
-    except HTTPException as http_err:
-        raise http_err  # Re-raise FastAPI HTTPExceptions
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
-
-    finally:
-        # Clean up the temporary JSON file after processing
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
 
 @app.get("/list-docs/organization/{organization_id}/workspace/{workspace_id}", response_model=list[DocumentInfo])
-def list_documents(organization_id: str, workspace_id: str):
-    return get_all_documents(organization_id, workspace_id)
+def list_documents(organization_id: str, workspace_id: str, response: Response, cursor: str | None = None,
+                   limit: int = Query(default=100, ge=1, le=1000)):
+    try:
+        documents, next_cursor = get_documents_page(organization_id, workspace_id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    _set_next_cursor(response, next_cursor)
+    return documents
 
 @app.post("/delete-doc")
 def delete_document(request: DeleteFileRequest):
-    # Delete from Chroma
-    chroma_delete_success = delete_doc_from_chroma(request.organization_id, request.workspace_id,request.file_id)
-
-    if chroma_delete_success:
-        # If successfully deleted from Chroma, delete from our database
-        db_delete_success = delete_document_record(request.file_id,  request.organization_id, request.workspace_id)
-        if db_delete_success:
-            return {"message": f"Successfully deleted document with file_id {request.file_id} from the system."}
-        else:
-            return {"error": f"Deleted from Chroma but failed to delete document with file_id {request.file_id} from the database."}
-    else:
-        return {"error": f"Failed to delete document with file_id {request.file_id} from Chroma."}
+    """ Delete a document once its queued uploads and updates have run, so none of them can re-add it """
+    job_id = submit_delete_job(request)
+    if not wait_for_ingestion_job(job_id, DELETE_WAIT_SECONDS):
+        return {"message": f"Deletion of file_id {request.file_id} is queued behind its pending jobs.",
+                "job_id": job_id}
+
+    job = get_ingestion_job(job_id)
+    if job["status"] == "completed":
+        return {"message": f"Successfully deleted document with file_id {request.file_id} from the system."}
+    return {"error": job["error"]}
 
 
 @app.post("/update-doc")
 def update_document(file : FileUpload):
+    """ Queue a document update; poll /jobs/{job_id} for progress """
+    job_id = submit_ingestion_job("update", file)
+    return {
+        "message": f"File {file.filename} has been queued for re-indexing.",
+        "file_id": file.file_id,
+        "job_id": job_id
+    }
 
-    temp_file_path = f"temp_{file.filename}.json"
 
-    try:
-        # Save the uploaded file to a temporary file
-        with open(temp_file_path, "w", encoding="utf-8") as json_file:
-            json.dump(file.model_dump(), json_file, ensure_ascii=False, indent=4)
-
-        update_document_record(file.file_id, file.organization_id,file.workspace_id,file.filename)
-
-        success = update_document_splits(temp_file_path, file.organization_id, file.workspace_id, file.file_id)
-
-        if success:
-            return {
-                "message": f"File {file.filename} has been successfully updated and indexed.",
-                "file_id": file.file_id
-            }
-        else:
-            delete_document_record(file.file_id, file.organization_id, file.workspace_id)
-            raise HTTPException(
-                status_code=500,
-                detail=f"Failed to index {file.filename}."
-            )
-    finally:
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+@app.get("/jobs/{job_id}", response_model=JobInfo)
+def get_job(job_id: str):
+    """ API endpoint to get the status and progress of an ingestion job """
+    job = get_ingestion_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return job
 
 
 # --- FastAPI Endpoints ---
@@ -166,13 +363,37 @@ def add_document(doc: FileRecord):
 
 # --- FastAPI Endpoints ---
 @app.get("/organizations/")
-def fetch_organizations():
-    """ API endpoint to get all organizations """
-    orgs = get_all_organizations()
+def fetch_organizations(response: Response, cursor: str | None = None, limit: int = Query(default=100, ge=1, le=1000)):
+    """ API endpoint to get organizations, one page at a time """
+    try:
+        orgs, next_cursor = get_organizations_page(limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    _set_next_cursor(response, next_cursor)
     return orgs if orgs else {"message": "No organizations found"}
 
 @app.get("/workspaces/{organization_id}")
-def fetch_workspaces(organization_id: str):
-    """ API endpoint to get all workspaces for a given organization """
-    workspaces = get_all_workspaces(organization_id)
-    return workspaces if workspaces else {"message": "No workspaces found"}
\ No newline at end of file
+def fetch_workspaces(organization_id: str, response: Response, cursor: str | None = None,
+                     limit: int = Query(default=100, ge=1, le=1000)):
+    """ API endpoint to get workspaces for a given organization, one page at a time """
+    try:
+        workspaces, next_cursor = get_workspaces_page(organization_id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    _set_next_cursor(response, next_cursor)
+    return workspaces if workspaces else {"message": "No workspaces found"}
+
+@app.get("/cache/stats")
+def cache_stats():
+    """ API endpoint to get hit rates of the answer, pipeline and vectorstore caches """
+    return {
+        "semantic_answer_cache": answer_cache.stats(),
+        "pipelines": pipeline_registry.stats(),
+        "vectorstores": vectorstore_cache.stats(),
+    }
+
+@app.get("/metrics")
+def metrics():
+    """ Prometheus scrape endpoint: per-stage latency, generation speed, retrieved chunks and ingestion throughput """
+    body, content_type = latest_metrics()
+    return Response(content=body, media_type=content_type)
@@ -0,0 +1,109 @@
+""" Maintenance commands for the Qdrant collections.
+
+Usage:
+    python manage.py migrate-to-shared [--organization ORG --workspace WS] [--delete-source] [--batch-size N]
+    python manage.py create-payload-indexes
+    python manage.py apply-profile [--organization ORG --workspace WS] [--recreate] [--batch-size N]
+
+The API caches its vectorstores per workspace; restart it after migrate-to-shared or apply-profile so it
+picks up the changed collections.
+"""
+import argparse
+import re
+
+from qdrant_utils import qdrant_client, migrate_workspace_to_shared, ensure_payload_indexes, SHARED_COLLECTION_NAME, \
+    SHARED_PAYLOAD_INDEXES, apply_collection_profile, collection_profile, embedding_vector_size, \
+    workspace_collection_name
+
+# Collection-per-workspace names; apply-profile's "<name>__reprofile" staging copies are not workspaces
+WORKSPACE_COLLECTION = re.compile(r"^org_(.+?)_workspace_(?!.*__reprofile$)(.+)$")
+RESTART_NOTE = "Restart the API so it picks up the changed collections."
+
+
+def list_workspace_collections():
+    """ (organization_id, workspace_id) of every collection-per-workspace collection """
+    workspaces = []
+    for collection in qdrant_client.get_collections().collections:
+        match = WORKSPACE_COLLECTION.match(collection.name)
+        if match:
+            workspaces.append((match.group(1), match.group(2)))
+    return workspaces
+
+
+def migrate_to_shared(args):
+    if args.organization and args.workspace:
+        workspaces = [(args.organization, args.workspace)]
+    else:
+        workspaces = list_workspace_collections()
+
+    total = 0
+    for organization_id, workspace_id in workspaces:
+        copied = migrate_workspace_to_shared(organization_id, workspace_id, args.batch_size, args.delete_source)
+        total += copied
+        print(f"org {organization_id} workspace {workspace_id}: {copied} points copied to {SHARED_COLLECTION_NAME}")
+    print(f"Migrated {len(workspaces)} workspaces, {total} points. Set QDRANT_MULTITENANT=true to serve from "
+          f"{SHARED_COLLECTION_NAME}. {RESTART_NOTE}")
+
+
+def create_payload_indexes(args):
+    """ Add the metadata payload indexes to collections created before they were part of collection setup """
+    for collection in qdrant_client.get_collections().collections:
+        if collection.name == SHARED_COLLECTION_NAME:
+            created = ensure_payload_indexes(collection.name, SHARED_PAYLOAD_INDEXES)
+        elif WORKSPACE_COLLECTION.match(collection.name):
+            created = ensure_payload_indexes(collection.name)
+        else:
+            continue
+        print(f"{collection.name}: {', '.join(created) if created else 'already indexed'}")
+
+
+def apply_profile(args):
+    """ Bring existing collections in line with the deployment's QDRANT_PROFILE settings """
+    print(f"Profile: {collection_profile.describe()}, vector size {embedding_vector_size()}")
+    if args.organization and args.workspace:
+        collections = [workspace_collection_name(args.organization, args.workspace)]
+    else:
+        collections = [collection.name for collection in qdrant_client.get_collections().collections
+                       if collection.name == SHARED_COLLECTION_NAME or WORKSPACE_COLLECTION.match(collection.name)]
+
+    for name in collections:
+        result = apply_collection_profile(name, multitenant=name == SHARED_COLLECTION_NAME,
+                                          batch_size=args.batch_size, recreate=args.recreate)
+        print(f"{name}: {result}")
+    print(RESTART_NOTE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate = commands.add_parser("migrate-to-shared",
+                                  help="Copy per-workspace collections into the shared multitenant collection")
+    migrate.add_argument("--organization", help="Only migrate this organization's workspace (requires --workspace)")
+    migrate.add_argument("--workspace", help="Only migrate this workspace (requires --organization)")
+    migrate.add_argument("--batch-size", type=int, default=256, help="Points copied per scroll/upsert")
+    migrate.add_argument("--delete-source", action="store_true",
+                         help="Drop each source collection once its points are verified in the shared collection")
+    migrate.set_defaults(handler=migrate_to_shared)
+
+    indexes = commands.add_parser("create-payload-indexes",
+                                  help="Add the metadata.file_id/template_id/staged payload indexes to existing collections")
+    indexes.set_defaults(handler=create_payload_indexes)
+
+    profile = commands.add_parser("apply-profile",
+                                  help="Update or recreate collections under the QDRANT_PROFILE collection profile")
+    profile.add_argument("--organization", help="Only this organization's workspace (requires --workspace)")
+    profile.add_argument("--workspace", help="Only this workspace (requires --organization)")
+    profile.add_argument("--batch-size", type=int, default=256, help="Points copied per scroll/upsert")
+    profile.add_argument("--recreate", action="store_true",
+                         help="Rebuild collections even when their settings could be updated in place")
+    profile.set_defaults(handler=apply_profile)
+
+    args = parser.parse_args()
+    if args.command in ("migrate-to-shared", "apply-profile") and bool(args.organization) != bool(args.workspace):
+        parser.error("--organization and --workspace must be given together")
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import os
+from typing import List
+
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+from db_utils import append_chat_messages, get_chat_session, update_chat_summary
+from prompt_utils import estimate_tokens
+from stream_utils import ThinkTagFilter
+
+# Server-side conversation memory per session_id, scoped to the organization and workspace the session was
+# started in. The newest turns are kept verbatim up to CHAT_HISTORY_TOKEN_BUDGET; older turns are folded into
+# a running summary by the chat model once they add up to CHAT_SUMMARY_MIN_TOKENS, so the summary is refreshed
+# every few turns rather than after each one. Until then they stay in the prompt verbatim.
+CHAT_MEMORY_ENABLED = os.getenv("CHAT_MEMORY_ENABLED", "true").lower() == "true"
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "800"))
+CHAT_SUMMARY_MIN_TOKENS = int(os.getenv("CHAT_SUMMARY_MIN_TOKENS", "400"))
+
+condense_prompt = ChatPromptTemplate.from_messages([
+    ("system", """Given the conversation so far and a follow-up question, rewrite the follow-up as a standalone question that can be understood without the conversation.
+Keep names, template ids, filenames, clause numbers and legal terms exactly as written. Reply with the question only."""),
+    MessagesPlaceholder("history"),
+    ("human", "Follow-up question: {question}"),
+])
+
+summary_prompt = ChatPromptTemplate.from_messages([
+    ("system", """Update the running summary of a conversation between a user and an assistant answering questions about document templates.
+Keep the user's goals, the facts established, and any template ids and filenames mentioned. Use at most 150 words. Reply with the summary only."""),
+    ("human", "Current summary:\n{summary}\n\nNew turns:\n{turns}"),
+])
+
+# Summaries run after the response; keep references so the tasks are not garbage collected
+_summary_tasks = set()
+# Sessions with a summary in flight; a turn finishing meanwhile does not start a second one
+_summarizing = set()
+
+
+def _strip_think(text: str) -> str:
+    think_filter = ThinkTagFilter()
+    return (think_filter.feed(text) + think_filter.flush()).strip()
+
+
+def _split_window(messages: List[dict]):
+    """ Split messages into (older, recent): recent is the newest run that fits the history token budget """
+    used = 0
+    start = len(messages)
+    while start > 0:
+        tokens = estimate_tokens(messages[start - 1]["content"])
+        if used + tokens > CHAT_HISTORY_TOKEN_BUDGET:
+            break
+        used += tokens
+        start -= 1
+    return messages[:start], messages[start:]
+
+
+def _tokens(messages: List[dict]) -> int:
+    return sum(estimate_tokens(message["content"]) for message in messages)
+
+
+async def load_history(session_id: str, organization_id: str, workspace_id: str) -> List[tuple]:
+    """ Prompt messages for a session: the running summary, then the recent turns within the token budget.
+    Empty for a session that belongs to another organization or workspace. """
+    summary, messages = await asyncio.to_thread(get_chat_session, session_id, organization_id, workspace_id)
+    older, recent = _split_window(messages)
+    # Older turns waiting to be summarised stay in; more than that means the summary is behind, so cut to the window
+    if _tokens(older) < CHAT_SUMMARY_MIN_TOKENS:
+        recent = messages
+    history = [("system", f"Summary of the earlier conversation: {summary}")] if summary else []
+    return history + [(message["role"], message["content"]) for message in recent]
+
+
+async def condense_question(llm, history: List[tuple], question: str) -> str:
+    """ Rewrite a follow-up into a standalone retrieval query; the question itself when there is no history """
+    if not history:
+        return question
+    chain = condense_prompt | llm | StrOutputParser()
+    standalone = _strip_think(await chain.ainvoke({"history": history, "question": question}))
+    return standalone or question
+
+
+async def save_turn(session_id: str, organization_id: str, workspace_id: str, question: str, answer: str) -> bool:
+    """ Store a question and its answer; False if the session belongs to another organization or workspace """
+    saved = await asyncio.to_thread(append_chat_messages, session_id, organization_id, workspace_id,
+                                    [("human", question), ("ai", answer)])
+    if not saved:
+        logging.warning(f"Session ID: {session_id}, used outside its workspace; the turn is not remembered")
+    return saved
+
+
+async def summarize_history(llm, session_id: str, organization_id: str, workspace_id: str):
+    """ Fold the turns that no longer fit the window into the session's running summary, once there are enough """
+    summary, messages = await asyncio.to_thread(get_chat_session, session_id, organization_id, workspace_id)
+    older, _ = _split_window(messages)
+    if not older or _tokens(older) < CHAT_SUMMARY_MIN_TOKENS:
+        return
+    turns = "\n".join(f"{message['role']}: {message['content']}" for message in older)
+    chain = summary_prompt | llm | StrOutputParser()
+    try:
+        new_summary = _strip_think(await chain.ainvoke({"summary": summary or "(none)", "turns": turns}))
+    except Exception:
+        logging.exception(f"Session ID: {session_id}, summarising the conversation failed")
+        return
+    await asyncio.to_thread(update_chat_summary, session_id, new_summary, older[-1]["id"])
+
+
+async def _summarize_once(llm, session_id: str, organization_id: str, workspace_id: str):
+    try:
+        await summarize_history(llm, session_id, organization_id, workspace_id)
+    finally:
+        _summarizing.discard(session_id)
+
+
+def schedule_summary(llm, session_id: str, organization_id: str, workspace_id: str):
+    """ Summarise in the background so the response is not held up by a second LLM call """
+    if session_id in _summarizing:
+        return
+    _summarizing.add(session_id)
+    task = asyncio.create_task(_summarize_once(llm, session_id, organization_id, workspace_id))
+    _summary_tasks.add(task)
+    task.add_done_callback(_summary_tasks.discard)
@@ -0,0 +1,117 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from opentelemetry import trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+# --- Tracing ---
+# Spans are exported in batches on a background thread: TRACE_EXPORTER=file appends one JSON span per line
+# to TRACE_FILE, console prints them, none (the default) only keeps the per-stage metrics below.
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+
+
+def _setup_tracing():
+    provider = TracerProvider(resource=Resource.create({"service.name": "rag-bot-api"}))
+    if TRACE_EXPORTER == "file":
+        exporter = ConsoleSpanExporter(out=open(TRACE_FILE, "a", encoding="utf-8"),
+                                       formatter=lambda span: span.to_json(indent=None) + "\n")
+        provider.add_span_processor(BatchSpanProcessor(exporter))
+    elif TRACE_EXPORTER == "console":
+        provider.add_span_processor(BatchSpanProcessor(ConsoleSpanExporter()))
+    trace.set_tracer_provider(provider)
+
+
+_setup_tracing()
+tracer = trace.get_tracer("rag-bot")
+
+# --- Metrics ---
+# Per-tenant labels can be switched off when there are too many workspaces for Prometheus to keep apart
+METRICS_TENANT_LABELS = os.getenv("METRICS_TENANT_LABELS", "true").lower() == "true"
+TENANT_LABELS = ["organization_id", "workspace_id"]
+
+STAGE_SECONDS = Histogram(
+    "rag_stage_seconds", "Latency of one stage of a chat or ingestion request", ["stage", *TENANT_LABELS],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+REQUEST_SECONDS = Histogram(
+    "rag_request_seconds", "End-to-end latency of chat requests", ["endpoint", *TENANT_LABELS],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+GENERATION_TOKENS_PER_SECOND = Histogram(
+    "rag_generation_tokens_per_second", "Estimated answer tokens per second of LLM generation",
+    ["model", *TENANT_LABELS], buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 250),
+)
+RETRIEVED_CHUNKS = Histogram(
+    "rag_retrieved_chunks", "Chunks returned by retrieval per question", TENANT_LABELS,
+    buckets=(0, 1, 2, 3, 5, 8, 10, 15, 20, 30, 50),
+)
+INGESTED_CHUNKS = Counter(
+    "rag_ingested_chunks", "Chunks embedded or upserted by ingestion", ["stage", *TENANT_LABELS],
+)
+INGESTION_CHUNKS_PER_SECOND = Histogram(
+    "rag_ingestion_chunks_per_second", "Embed-and-upsert throughput of one indexing call", TENANT_LABELS,
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500),
+)
+
+
+def tenant(organization_id: Optional[str] = None, workspace_id: Optional[str] = None) -> dict:
+    """ Label values for a tenant; collapsed to "all" when METRICS_TENANT_LABELS is off """
+    if not METRICS_TENANT_LABELS:
+        return {"organization_id": "all", "workspace_id": "all"}
+    return {"organization_id": organization_id or "", "workspace_id": workspace_id or ""}
+
+
+@contextmanager
+def stage(name: str, timings: Optional[dict] = None, organization_id: Optional[str] = None,
+          workspace_id: Optional[str] = None, **attributes):
+    """ Trace a stage as a span and record its latency in rag_stage_seconds (and timings[name], if given) """
+    labels = tenant(organization_id, workspace_id)
+    with tracer.start_as_current_span(name, attributes={**labels, **attributes}) as span:
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            elapsed = time.perf_counter() - start
+            STAGE_SECONDS.labels(stage=name, **labels).observe(elapsed)
+            if timings is not None:
+                timings[name] = elapsed
+
+
+def observe_stage(name: str, seconds: float, organization_id: Optional[str] = None,
+                  workspace_id: Optional[str] = None):
+    """ Record a stage latency measured elsewhere, e.g. time to first token """
+    STAGE_SECONDS.labels(stage=name, **tenant(organization_id, workspace_id)).observe(seconds)
+
+
+def latest_metrics():
+    """ (body, content type) of the Prometheus exposition """
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class RequestTrace:
+    """ Root span and end-to-end latency of one request. Unlike stage() it can stay open across the body
+    of a streaming response: activate() makes it current for a block, end() closes it once. """
+
+    def __init__(self, endpoint: str, organization_id: Optional[str] = None, workspace_id: Optional[str] = None,
+                 **attributes):
+        self.endpoint = endpoint
+        self.labels = tenant(organization_id, workspace_id)
+        self.span = tracer.start_span(endpoint, attributes={**self.labels, **attributes})
+        self._start = time.perf_counter()
+        self._ended = False
+
+    def activate(self):
+        return trace.use_span(self.span, end_on_exit=False)
+
+    def end(self):
+        if self._ended:
+            return
+        self._ended = True
+        REQUEST_SECONDS.labels(endpoint=self.endpoint, **self.labels).observe(time.perf_counter() - self._start)
+        self.span.end()
@@ -0,0 +1,169 @@
+import functools
+import logging
+import os
+import re
+from typing import List, Optional, Sequence
+
+from langchain_core.documents import Document
+
+# Retrieved chunks are put into the prompt once each, most relevant first, until CONTEXT_TOKEN_BUDGET is used
+# or the model's window (PROMPT_CONTEXT_WINDOW, the num_ctx the Ollama models run with) would be exceeded
+# once the instructions, history, question and ANSWER_TOKEN_RESERVE tokens for the answer are counted.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+PROMPT_CONTEXT_WINDOW = int(os.getenv("PROMPT_CONTEXT_WINDOW", "4096"))
+ANSWER_TOKEN_RESERVE = int(os.getenv("ANSWER_TOKEN_RESERVE", "1024"))
+# Ollama does not expose its tokenizers; prompts are counted with tiktoken, using the model's own encoding when
+# tiktoken knows it, else this one (Llama 3's tokenizer is built on cl100k_base)
+PROMPT_TOKENIZER_ENCODING = os.getenv("PROMPT_TOKENIZER_ENCODING", "cl100k_base")
+# Without tiktoken (or its encoding files) tokens are estimated, and this fraction of the window is held back
+# in case the estimate runs low
+TOKEN_ESTIMATE_MARGIN = float(os.getenv("TOKEN_ESTIMATE_MARGIN", "0.15"))
+# Repeated runs of at least this many words within one file (e.g. the overlap between the pieces of a long
+# section) are only kept the first time
+CONTEXT_DEDUPE_MIN_WORDS = int(os.getenv("CONTEXT_DEDUPE_MIN_WORDS", "20"))
+# A chunk that would have to be cut below this many tokens is left out instead
+MIN_CHUNK_TOKENS = 32
+
+
+def estimate_tokens(text: str) -> int:
+    """ Rough token count (about four characters per token), good enough for budgeting the prompt """
+    return len(text) // 4 + 1
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model: Optional[str]):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model or "")
+    except KeyError:
+        try:
+            return tiktoken.get_encoding(PROMPT_TOKENIZER_ENCODING)
+        except Exception:
+            # e.g. the encoding file cannot be downloaded on an offline node
+            logging.warning(f"tiktoken encoding {PROMPT_TOKENIZER_ENCODING} unavailable; estimating prompt tokens")
+            return None
+
+
+def is_estimated(model: Optional[str] = None) -> bool:
+    """ Whether count_tokens falls back to estimate_tokens for model """
+    return _encoding(model) is None
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """ Tokens of text for model: exact with tiktoken installed, estimated otherwise """
+    encoding = _encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: Optional[str] = None) -> str:
+    """ The longest word-aligned prefix of text within max_tokens """
+    encoding = _encoding(model)
+    if encoding is None:
+        prefix = text[:max(max_tokens - 1, 0) * 4]
+    else:
+        prefix = encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    if len(prefix) < len(text) and " " in prefix:
+        prefix = prefix.rsplit(" ", 1)[0]
+    return prefix.rstrip()
+
+
+def _source(doc: Document):
+    return doc.metadata.get("file_id", doc.metadata.get("template_id"))
+
+
+def dedupe_documents(docs: Sequence[Document], min_words: int = CONTEXT_DEDUPE_MIN_WORDS) -> List[Document]:
+    """ Drop repeated chunks and cut text a chunk shares with a more relevant chunk of the same file.
+    Identical chunks are dropped across files; partial overlaps are only removed within a file, so boilerplate
+    that two different templates share is still shown for each of them. """
+    seen_texts = set()
+    seen_runs = {}
+    deduped = []
+    for doc in docs:
+        normalized = " ".join(doc.page_content.split())
+        if not normalized or normalized in seen_texts:
+            continue
+        seen_texts.add(normalized)
+
+        # Words with their trailing whitespace, so the kept text keeps its line breaks
+        tokens = re.findall(r"\S+\s*", doc.page_content)
+        words = [token.strip() for token in tokens]
+        runs = seen_runs.setdefault(_source(doc), set())
+        covered = [False] * len(tokens)
+        new_runs = set()
+        for start in range(len(words) - min_words + 1):
+            run = tuple(words[start:start + min_words])
+            if run in runs:
+                covered[start:start + min_words] = [True] * min_words
+            new_runs.add(run)
+        runs.update(new_runs)
+
+        if all(covered):
+            continue
+        if not any(covered):
+            deduped.append(doc)
+            continue
+        # Replace every removed stretch with a single ellipsis
+        parts = []
+        for token, is_covered in zip(tokens, covered):
+            if not is_covered:
+                parts.append(token)
+            elif not parts or parts[-1] != "… ":
+                parts.append("… ")
+        deduped.append(Document(page_content="".join(parts).strip(), metadata=doc.metadata))
+    return deduped
+
+
+class PromptBuilder:
+    """ Fits retrieved chunks into the context part of the prompt for one model """
+
+    def __init__(self, model: Optional[str] = None, fixed_tokens: int = 0,
+                 context_budget: int = CONTEXT_TOKEN_BUDGET, context_window: int = PROMPT_CONTEXT_WINDOW,
+                 answer_reserve: int = ANSWER_TOKEN_RESERVE):
+        self.model = model
+        # Tokens of the prompt template itself (instructions, formatting)
+        self.fixed_tokens = fixed_tokens
+        self.context_budget = context_budget
+        self.context_window = context_window
+        self.answer_reserve = answer_reserve
+
+    def available_tokens(self, question: str, history: Sequence[tuple] = ()) -> int:
+        """ Context tokens left once everything else in the prompt and the answer are accounted for """
+        used = self.fixed_tokens + self.answer_reserve + count_tokens(question, self.model)
+        used += sum(count_tokens(content, self.model) for _, content in history)
+        window = self.context_window
+        if is_estimated(self.model):
+            window -= int(window * TOKEN_ESTIMATE_MARGIN)
+        return max(min(self.context_budget, window - used), 0)
+
+    @staticmethod
+    def format_document(index: int, doc: Document, text: str) -> str:
+        template_id = doc.metadata.get("template_id", "N/A")
+        filename = doc.metadata.get("filename", "N/A")
+        return f"[{index}] template_id: {template_id} | filename: {filename}\n{text}"
+
+    def build_context(self, docs: Sequence[Document], question: str, history: Sequence[tuple] = ()):
+        """ (context text, documents used, context tokens). docs must be ordered most relevant first. """
+        budget = self.available_tokens(question, history)
+        blocks, used_docs, used = [], [], 0
+        for doc in dedupe_documents(docs):
+            block = self.format_document(len(blocks) + 1, doc, doc.page_content)
+            # Blocks are joined by a blank line, about one token
+            tokens = count_tokens(block, self.model) + 1
+            if used + tokens > budget:
+                remaining = budget - used - (tokens - count_tokens(doc.page_content, self.model))
+                if remaining < MIN_CHUNK_TOKENS:
+                    continue
+                block = self.format_document(len(blocks) + 1, doc,
+                                             truncate_to_tokens(doc.page_content, remaining, self.model))
+                tokens = count_tokens(block, self.model) + 1
+                if used + tokens > budget:
+                    continue
+            blocks.append(block)
+            used_docs.append(doc)
+            used += tokens
+        return "\n\n".join(blocks), used_docs, used
@@ -53,3 +53,18 @@ class FileRecord(BaseModel):
     filename: str
     organization_id: str
     workspace_id: str
+
+class JobInfo(BaseModel):
+    id: str
+    job_type: str
+    status: str
+    organization_id: str
+    workspace_id: str
+    file_id: str
+    attempts: int
+    chunks_split: int
+    chunks_embedded: int
+    chunks_upserted: int
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
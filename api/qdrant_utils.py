@@ -1,66 +1,657 @@
 import json
-from langchain_text_splitters import RecursiveJsonSplitter
 from langchain_ollama import OllamaEmbeddings
-from typing import List
+from typing import Any, Iterator, List, Optional
 from langchain_core.documents import Document
-from langchain_qdrant import QdrantVectorStore
-from qdrant_client.http.models import Distance, VectorParams
+from langchain_core.embeddings import Embeddings
+from langchain_qdrant import QdrantVectorStore, RetrievalMode
 from dotenv import load_dotenv
-from qdrant_client import QdrantClient
+from qdrant_client import AsyncQdrantClient, QdrantClient
 from qdrant_client.http import models
+from cache_utils import LRUTTLCache, SQLiteEmbeddingCache
+from chunk_utils import section_chunker
+from collection_utils import load_profile
+from sparse_utils import BM25SparseEmbeddings
+from metrics_utils import stage, tenant, INGESTED_CHUNKS, INGESTION_CHUNKS_PER_SECOND
+from pydantic_models import FileUpload
+import asyncio
+import contextvars
+import logging
 import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 load_dotenv()
+logger = logging.getLogger(__name__)
 qdrant_url = os.getenv('QDRANT_URL')
 qdrant_api_key=os.getenv('QDRANT_API_KEY')
 
-qdrant_client = QdrantClient(
-url="http://localhost:6333"
+# QDRANT_LOCATION runs Qdrant in-process instead of against the server: ":memory:" or a directory path.
+# Local mode has no shared async client, so async searches then run the sync client in a thread.
+QDRANT_LOCATION = os.getenv("QDRANT_LOCATION")
+if QDRANT_LOCATION:
+    qdrant_client = QdrantClient(location=QDRANT_LOCATION) if QDRANT_LOCATION == ":memory:" \
+        else QdrantClient(path=QDRANT_LOCATION)
+    async_qdrant_client = None
+else:
+    qdrant_client = QdrantClient(
+    url="http://localhost:6333"
+    )
+    async_qdrant_client = AsyncQdrantClient(
+    url="http://localhost:6333"
+    )
+
+
+class CachedEmbeddings(Embeddings):
+    """ Embeddings wrapper that looks chunks up in a persistent cache keyed by (model, SHA-256 of the text)
+    and only sends the misses to the underlying model """
+
+    def __init__(self, embeddings: Embeddings, model: str, cache: SQLiteEmbeddingCache):
+        self.embeddings = embeddings
+        self.model = model
+        self.cache = cache
+
+    def embed_documents_with_stats(self, texts: List[str]) -> tuple[List[List[float]], dict]:
+        hashes = [self.cache.text_hash(text) for text in texts]
+        vectors = self.cache.get_many(self.model, set(hashes))
+
+        # Embed each missing text once, even if it repeats within the batch
+        missing = {}
+        for text_hash, text in zip(hashes, texts):
+            if text_hash not in vectors:
+                missing.setdefault(text_hash, text)
+        if missing:
+            new_vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), new_vectors))
+            self.cache.put_many(self.model, new_items)
+            vectors.update(new_items)
+
+        stats = {"hits": len(texts) - len(missing), "misses": len(missing)}
+        return [vectors[text_hash] for text_hash in hashes], stats
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_documents_with_stats(texts)[0]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.embeddings.aembed_query(text)
+
+
+EMBEDDING_MODEL = "nomic-embed-text"
+embedding_cache = SQLiteEmbeddingCache(os.getenv("EMBEDDING_CACHE_DB", "embedding_cache.db"))
+embedding_function = CachedEmbeddings(OllamaEmbeddings(model=EMBEDDING_MODEL), EMBEDDING_MODEL, embedding_cache)
+# Dense vector size of new collections; detected from the embedding model unless set explicitly
+QDRANT_VECTOR_SIZE = int(os.getenv("QDRANT_VECTOR_SIZE", "0"))
+_vector_size = QDRANT_VECTOR_SIZE or None
+
+
+def embedding_vector_size() -> int:
+    """ Dimension of EMBEDDING_MODEL's vectors, probed with one embedding the first time it is needed """
+    global _vector_size
+    if _vector_size is None:
+        _vector_size = len(embedding_function.embed_query("vector size probe"))
+    return _vector_size
+
+
+# Building a QdrantVectorStore checks the collection and validates its config on every call,
+# so keep ready-to-use stores per workspace.
+vectorstore_cache = LRUTTLCache(
+    maxsize=int(os.getenv("VECTORSTORE_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("VECTORSTORE_CACHE_TTL", "600")),
 )
 
-text_splitter = RecursiveJsonSplitter(max_chunk_size =2500, min_chunk_size=1500)
-embedding_function = OllamaEmbeddings(model="nomic-embed-text")
+# Quantization, on-disk and HNSW settings of new collections (see collection_utils)
+collection_profile = load_profile()
+
+# BM25 vectors stored next to the dense ones for hybrid retrieval
+SPARSE_VECTOR_NAME = "bm25"
+sparse_embedding_function = BM25SparseEmbeddings()
+# Candidates fetched from each of the dense and sparse searches per requested result before fusion
+HYBRID_PREFETCH_MULTIPLIER = int(os.getenv("HYBRID_PREFETCH_MULTIPLIER", "4"))
+
+# --- Storage mode ---
+# By default every workspace gets its own collection org_{org}_workspace_{ws}. With QDRANT_MULTITENANT=true all
+# workspaces share one collection; each point carries its organization/workspace in the payload and every
+# search, scroll and delete is filtered on them.
+QDRANT_MULTITENANT = os.getenv("QDRANT_MULTITENANT", "false").lower() == "true"
+SHARED_COLLECTION_NAME = os.getenv("QDRANT_SHARED_COLLECTION", "rag_documents")
+
+# Chunks written by a document update are staged (metadata.staged=true) and hidden from search until the update
+# switches over to them; see update_document_splits
+STAGED_KEY = "metadata.staged"
+STAGED = models.FieldCondition(key=STAGED_KEY, match=models.MatchValue(value=True))
+
+# Payload indexes for the metadata fields we filter on: file_id for deletes, updates and file-scoped chat;
+# template_id (set for numeric file_ids) for filtering by template; staged, which every search excludes
+PAYLOAD_INDEXES = {
+    "metadata.file_id": models.PayloadSchemaType.KEYWORD,
+    "metadata.template_id": models.PayloadSchemaType.INTEGER,
+    STAGED_KEY: models.PayloadSchemaType.BOOL,
+}
+# The shared collection also indexes the tenant fields, which lets Qdrant co-locate each workspace's points
+SHARED_PAYLOAD_INDEXES = {
+    "metadata.organization_id": models.KeywordIndexParams(type=models.KeywordIndexType.KEYWORD, is_tenant=True),
+    "metadata.workspace_id": models.KeywordIndexParams(type=models.KeywordIndexType.KEYWORD, is_tenant=True),
+    **PAYLOAD_INDEXES,
+}
+
+
+def workspace_collection_name(organization_id: str, workspace_id: str) -> str:
+    return f"org_{organization_id}_workspace_{workspace_id}"
+
 
 def get_org_workspace_vectorstore(organization_id: str, workspace_id: str):
-    collection_name = f"org_{organization_id}_workspace_{workspace_id}"
-    collection=qdrant_client.collection_exists(collection_name=collection_name)
-    if not collection:
-        qdrant_client.create_collection(
-            collection_name=collection_name, vectors_config=VectorParams(size=1536, distance=Distance.COSINE),
+    return vectorstore_cache.get_or_create(
+        (organization_id, workspace_id),
+        lambda: _create_org_workspace_vectorstore(organization_id, workspace_id),
+    )
+
+def invalidate_workspace_vectorstore(organization_id: str, workspace_id: str):
+    vectorstore_cache.invalidate(lambda key: key == (organization_id, workspace_id))
+
+class AsyncQdrantVectorStore(QdrantVectorStore):
+    """ QdrantVectorStore whose async searches use AsyncQdrantClient and async embeddings
+    instead of running the sync methods in a thread executor """
+
+    def __init__(self, async_client: Optional[AsyncQdrantClient], tenant: Optional[dict] = None, labels: Optional[dict] = None,
+                 search_params: Optional[models.SearchParams] = None, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.async_client = async_client
+        # Dense search parameters of the collection's profile, e.g. rescoring of quantized vectors
+        self.search_params = search_params
+        # Metadata that scopes this store within a shared collection, e.g. {"organization_id": ..., "workspace_id": ...}
+        self.tenant = tenant or {}
+        # Organization/workspace labels for spans and metrics, in both storage modes
+        self.labels = labels or {}
+
+    @property
+    def has_sparse_vectors(self) -> bool:
+        """ Whether the collection stores BM25 vectors next to the dense ones """
+        return self.retrieval_mode == RetrievalMode.HYBRID
+
+    def scoped_filter(self, filter: Optional[models.Filter | dict] = None) -> Optional[models.Filter]:
+        """ Restrict filter to this store's tenant; a no-op for collection-per-workspace stores """
+        # FilteredVectorStoreRetrieverWithFilter passes its filter as a plain dict
+        if isinstance(filter, dict):
+            filter = models.Filter(**filter)
+        if not self.tenant:
+            return filter
+        conditions = [
+            models.FieldCondition(key=f"{self.metadata_payload_key}.{key}", match=models.MatchValue(value=value))
+            for key, value in self.tenant.items()
+        ]
+        return models.Filter(must=conditions + ([filter] if filter else []))
+
+    def search_filter(self, filter: Optional[models.Filter | dict] = None) -> models.Filter:
+        """ scoped_filter, also hiding the staged chunks of updates that have not switched over yet """
+        filter = self.scoped_filter(filter)
+        return models.Filter(must=[filter] if filter else None, must_not=[STAGED])
+
+    def _query_options(self, embedding: List[float], query: Optional[str], k: int,
+                       filter: Optional[models.Filter | dict], hybrid: bool, **kwargs: Any) -> dict:
+        """ query_points arguments: a dense search, or with hybrid=True (and BM25 vectors in the collection)
+        dense and sparse candidates merged by reciprocal rank fusion """
+        kwargs.pop("hybrid_fusion", None)
+        filter = self.search_filter(filter)
+        options = {
+            "collection_name": self.collection_name,
+            "query_filter": filter,
+            "limit": k,
+            "with_payload": True,
+            "with_vectors": False,
+            **kwargs,
+        }
+        search_params = options.pop("search_params", None) or self.search_params
+        if not (hybrid and query and self.has_sparse_vectors):
+            return {**options, "query": embedding, "using": self.vector_name, "search_params": search_params}
+
+        sparse = self.sparse_embeddings.embed_query(query)
+        prefetch_limit = k * HYBRID_PREFETCH_MULTIPLIER
+        return {
+            **options,
+            "prefetch": [
+                models.Prefetch(query=embedding, using=self.vector_name, filter=filter, limit=prefetch_limit,
+                                params=search_params),
+                models.Prefetch(
+                    query=models.SparseVector(indices=sparse.indices, values=sparse.values),
+                    using=self.sparse_vector_name, filter=filter, limit=prefetch_limit,
+                ),
+            ],
+            "query": models.FusionQuery(fusion=models.Fusion.RRF),
+        }
+
+    def _documents_with_scores(self, points) -> List[tuple[Document, float]]:
+        return [
+            (
+                self._document_from_point(point, self.collection_name, self.content_payload_key, self.metadata_payload_key),
+                point.score,
+            )
+            for point in points
+        ]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: Optional[models.Filter | dict] = None, hybrid: bool = False, **kwargs: Any
+    ) -> List[tuple[Document, float]]:
+        with stage("embed_query", **self.labels):
+            embedding = self.embeddings.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k, filter=filter, query=query, hybrid=hybrid, **kwargs)
+
+    def similarity_search_with_score_by_vector(
+        self, embedding: List[float], k: int = 4, filter: Optional[models.Filter | dict] = None,
+        query: Optional[str] = None, hybrid: bool = False, **kwargs: Any
+    ) -> List[tuple[Document, float]]:
+        with stage("qdrant_search", **self.labels, collection=self.collection_name, hybrid=hybrid):
+            results = self.client.query_points(**self._query_options(embedding, query, k, filter, hybrid, **kwargs))
+        return self._documents_with_scores(results.points)
+
+    async def asimilarity_search_with_score_by_vector(
+        self, embedding: List[float], k: int = 4, filter: Optional[models.Filter | dict] = None,
+        query: Optional[str] = None, hybrid: bool = False, **kwargs: Any
+    ) -> List[tuple[Document, float]]:
+        options = self._query_options(embedding, query, k, filter, hybrid, **kwargs)
+        with stage("qdrant_search", **self.labels, collection=self.collection_name, hybrid=hybrid):
+            if self.async_client is None:
+                results = await asyncio.to_thread(self.client.query_points, **options)
+            else:
+                results = await self.async_client.query_points(**options)
+        return self._documents_with_scores(results.points)
+
+    async def asimilarity_search_with_score(
+        self, query: str, k: int = 4, filter: Optional[models.Filter | dict] = None, **kwargs: Any
+    ) -> List[tuple[Document, float]]:
+        with stage("embed_query", **self.labels):
+            embedding = await self.embeddings.aembed_query(query)
+        return await self.asimilarity_search_with_score_by_vector(embedding, k=k, filter=filter, query=query, **kwargs)
+
+    async def asimilarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, filter: Optional[models.Filter | dict] = None, **kwargs: Any
+    ) -> List[Document]:
+        results = await self.asimilarity_search_with_score_by_vector(embedding, k=k, filter=filter, **kwargs)
+        return [doc for doc, _ in results]
+
+    async def asimilarity_search(
+        self, query: str, k: int = 4, filter: Optional[models.Filter | dict] = None, **kwargs: Any
+    ) -> List[Document]:
+        results = await self.asimilarity_search_with_score(query, k=k, filter=filter, **kwargs)
+        return [doc for doc, _ in results]
+
+
+def _vectorstore_for(collection_name: str, organization_id: str, workspace_id: str,
+                     tenant: Optional[dict] = None) -> AsyncQdrantVectorStore:
+    config = qdrant_client.get_collection(collection_name).config
+    # Collections created before BM25 support have no sparse vectors and stay dense-only
+    sparse_vectors = config.params.sparse_vectors or {}
+    hybrid_kwargs = {}
+    if SPARSE_VECTOR_NAME in sparse_vectors:
+        hybrid_kwargs = {"retrieval_mode": RetrievalMode.HYBRID, "sparse_embedding": sparse_embedding_function,
+                         "sparse_vector_name": SPARSE_VECTOR_NAME}
+    return AsyncQdrantVectorStore(
+        async_client=async_qdrant_client, client=qdrant_client, collection_name=collection_name,
+        embedding=embedding_function, tenant=tenant,
+        labels={"organization_id": organization_id, "workspace_id": workspace_id},
+        search_params=collection_profile.search_params(quantized=config.quantization_config is not None),
+        **hybrid_kwargs
+    )
+
+
+def _create_org_workspace_vectorstore(organization_id: str, workspace_id: str):
+    if QDRANT_MULTITENANT:
+        ensure_shared_collection()
+        return _vectorstore_for(SHARED_COLLECTION_NAME, organization_id, workspace_id,
+                                tenant={"organization_id": organization_id, "workspace_id": workspace_id})
+
+    collection_name = workspace_collection_name(organization_id, workspace_id)
+    _ensure_collection(collection_name, embedding_vector_size(), PAYLOAD_INDEXES)
+    return _vectorstore_for(collection_name, organization_id, workspace_id)
+
+
+# Serialises collection creation: the first uploads to a new workspace often arrive together
+_collection_create_lock = threading.Lock()
+
+
+def _ensure_collection(collection_name: str, vector_size: int, indexes: dict, multitenant: bool = False):
+    """ Create a collection under the profile with its payload indexes, unless it already exists """
+    if qdrant_client.collection_exists(collection_name=collection_name):
+        return
+    with _collection_create_lock:
+        try:
+            qdrant_client.create_collection(
+                collection_name=collection_name,
+                **collection_profile.collection_kwargs(vector_size, SPARSE_VECTOR_NAME, multitenant),
+            )
+        except Exception:
+            # Another API process may have created it in the meantime
+            if not qdrant_client.collection_exists(collection_name=collection_name):
+                raise
+            return
+        ensure_payload_indexes(collection_name, indexes)
+
+
+def ensure_shared_collection(vector_size: Optional[int] = None):
+    """ Create the multitenant collection with its tenant payload indexes if it does not exist yet """
+    _ensure_collection(SHARED_COLLECTION_NAME, vector_size or embedding_vector_size(), SHARED_PAYLOAD_INDEXES,
+                       multitenant=True)
+
+
+def ensure_payload_indexes(collection_name: str, indexes: Optional[dict] = None) -> List[str]:
+    """ Create whichever of the payload indexes the collection is missing; returns the fields indexed now """
+    indexes = indexes or PAYLOAD_INDEXES
+    existing = qdrant_client.get_collection(collection_name).payload_schema or {}
+    created = []
+    for field_name, field_schema in indexes.items():
+        if field_name in existing:
+            continue
+        qdrant_client.create_payload_index(
+            collection_name=collection_name, field_name=field_name, field_schema=field_schema
         )
+        created.append(field_name)
+    return created
+
+
+def migrate_workspace_to_shared(organization_id: str, workspace_id: str, batch_size: int = 256,
+                                delete_source: bool = False) -> int:
+    """ Copy the points of a per-workspace collection into the shared collection, tagging each with its tenant.
+    Point IDs are namespaced by the tenant, since workspace collections may share IDs; they stay deterministic,
+    so running it again is idempotent. Returns the number of points copied. Runs from manage.py, outside the
+    API, so API processes keep their cached vectorstores until they are restarted. """
+    source = workspace_collection_name(organization_id, workspace_id)
+    ensure_shared_collection(dense_vector_size(qdrant_client.get_collection(source)))
+
+    tenant = {"organization_id": organization_id, "workspace_id": workspace_id}
+    copied = 0
+    offset = None
+    while True:
+        points, offset = qdrant_client.scroll(
+            collection_name=source, limit=batch_size, offset=offset, with_payload=True, with_vectors=True
+        )
+        if points:
+            qdrant_client.upsert(
+                collection_name=SHARED_COLLECTION_NAME,
+                points=[
+                    models.PointStruct(
+                        id=str(uuid.uuid5(POINT_ID_NAMESPACE, f"{organization_id}:{workspace_id}:{point.id}")),
+                        vector=_with_sparse_vector(point),
+                        payload={**point.payload, "metadata": {**(point.payload.get("metadata") or {}), **tenant}},
+                    )
+                    for point in points
+                ],
+            )
+            copied += len(points)
+        if offset is None:
+            break
+
+    if delete_source:
+        shared_count = qdrant_client.count(
+            collection_name=SHARED_COLLECTION_NAME,
+            count_filter=models.Filter(must=[
+                models.FieldCondition(key=f"metadata.{key}", match=models.MatchValue(value=value))
+                for key, value in tenant.items()
+            ]),
+            exact=True,
+        ).count
+        if shared_count < copied:
+            raise RuntimeError(f"Only {shared_count} of {copied} points of {source} found in {SHARED_COLLECTION_NAME}; "
+                               f"keeping the source collection.")
+        qdrant_client.delete_collection(source)
+    return copied
+
+def dense_vector_size(info: models.CollectionInfo) -> Optional[int]:
+    """ Size of a collection's unnamed dense vector """
+    vectors = info.config.params.vectors
+    vectors = vectors.get("") if isinstance(vectors, dict) else vectors
+    return vectors.size if vectors is not None else None
 
-    vectorstore=QdrantVectorStore(client=qdrant_client, collection_name=collection_name, embedding=embedding_function)
-    return vectorstore
 
-def load_and_split_document(file_path: str) -> List[Document]:
+def apply_collection_profile(collection_name: str, multitenant: bool = False, batch_size: int = 256,
+                             recreate: bool = False) -> str:
+    """ Bring an existing collection in line with collection_profile; returns what was done.
+    Settings Qdrant can change on a live collection (quantization, on-disk, HNSW) are updated in place and the
+    indexes rebuild in the background. A different vector size, or recreate=True, rebuilds the collection:
+    points are copied to a temporary collection, the collection is created again under the profile and the
+    points copied back, re-embedding page_content when the vector size changes. Writes made to the collection
+    while it is rebuilt are lost, so pause ingestion for it. API processes keep searching with the settings of
+    the vectorstores they have cached, so restart them afterwards. """
+    info = qdrant_client.get_collection(collection_name)
+    vector_size = embedding_vector_size()
+    if collection_profile.matches(info, vector_size, multitenant):
+        return "already matches the profile"
+
+    if dense_vector_size(info) == vector_size and not recreate:
+        updated = qdrant_client.update_collection(
+            collection_name=collection_name,
+            vectors_config={"": models.VectorParamsDiff(on_disk=collection_profile.on_disk)},
+            hnsw_config=collection_profile.hnsw_config(multitenant),
+            quantization_config=collection_profile.quantization_config() or models.Disabled.DISABLED,
+        )
+        if updated:
+            return "updated in place"
+
+    indexes = SHARED_PAYLOAD_INDEXES if multitenant else PAYLOAD_INDEXES
+    kwargs = collection_profile.collection_kwargs(vector_size, SPARSE_VECTOR_NAME, multitenant)
+    staging = f"{collection_name}__reprofile"
+    if qdrant_client.collection_exists(staging):
+        raise RuntimeError(f"{staging} already exists, probably from an interrupted run; "
+                           f"check it and delete it before trying again.")
+    qdrant_client.create_collection(collection_name=staging, **kwargs)
+    copied = _copy_points(collection_name, staging, batch_size)
+
+    qdrant_client.delete_collection(collection_name)
+    qdrant_client.create_collection(collection_name=collection_name, **kwargs)
+    ensure_payload_indexes(collection_name, indexes)
+    restored = _copy_points(staging, collection_name, batch_size)
+    if restored < copied:
+        raise RuntimeError(f"Only {restored} of {copied} points restored to {collection_name}; "
+                           f"the originals are kept in {staging}.")
+    qdrant_client.delete_collection(staging)
+    return f"recreated with {copied} points"
+
+
+def _copy_points(source: str, target: str, batch_size: int) -> int:
+    """ Copy every point from source to target, re-embedding the dense vector when the sizes differ """
+    reembed = dense_vector_size(qdrant_client.get_collection(source)) != \
+        dense_vector_size(qdrant_client.get_collection(target))
+    copied = 0
+    offset = None
+    while True:
+        points, offset = qdrant_client.scroll(
+            collection_name=source, limit=batch_size, offset=offset, with_payload=True, with_vectors=True
+        )
+        if points:
+            vectors = [_with_sparse_vector(point) for point in points]
+            if reembed:
+                dense = embedding_function.embed_documents([point.payload.get("page_content", "") for point in points])
+                for point_vectors, vector in zip(vectors, dense):
+                    point_vectors[""] = vector
+            qdrant_client.upsert(
+                collection_name=target,
+                points=[models.PointStruct(id=point.id, vector=point_vectors, payload=point.payload)
+                        for point, point_vectors in zip(points, vectors)],
+            )
+            copied += len(points)
+        if offset is None:
+            break
+    return copied
+
+
+def _with_sparse_vector(point) -> dict:
+    """ Vectors of a scrolled point, adding the BM25 vector when its source collection had none """
+    vectors = dict(point.vector) if isinstance(point.vector, dict) else {"": point.vector}
+    if SPARSE_VECTOR_NAME not in vectors:
+        sparse = sparse_embedding_function.embed_documents([point.payload.get("page_content", "")])[0]
+        vectors[SPARSE_VECTOR_NAME] = models.SparseVector(indices=sparse.indices, values=sparse.values)
+    return vectors
+
+
+def split_document(file: FileUpload) -> Iterator[Document]:
+    """ Split an uploaded document along its heading/content sections (see chunk_utils) """
+    return section_chunker.split(file)
+
+
+def prepare_splits(file: FileUpload, file_id: str) -> List[Document]:
+    """ Split a document and attach the metadata stored with every chunk """
+    splits = list(split_document(file))
+    for split in splits:
+        split.metadata['file_id'] = file_id
+    return splits
+
+
+# Bounded concurrency per backend for ingestion, so background jobs cannot swamp Ollama or Qdrant.
+# The embedding pool size is the node-wide number of concurrent Ollama embedding requests.
+embedding_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("INGEST_EMBED_CONCURRENCY", "2")), thread_name_prefix="embed"
+)
+qdrant_write_slots = threading.BoundedSemaphore(int(os.getenv("INGEST_QDRANT_CONCURRENCY", "4")))
+
+# Chunks per embedding request, and how many batches one job keeps embedding while it upserts the previous one
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+EMBED_BATCHES_IN_FLIGHT = int(os.getenv("EMBED_BATCHES_IN_FLIGHT", "2"))
+
+
+def _report(progress, stage: str, count: int):
+    if progress and count:
+        progress(stage, count)
+
+
+# Point IDs are derived from the chunk itself, so re-indexing an unchanged chunk maps onto the same point
+POINT_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "rag-bot-nomia/qdrant-points")
+
+
+def chunk_point_ids(file_id: str, splits: List[Document], tenant: Optional[dict] = None) -> List[str]:
+    """ Deterministic point ID per split from its content, metadata and position among identical chunks.
+    In the shared collection the tenant is part of the ID, so workspaces using the same file_id and content
+    do not overwrite each other's points. """
+    scope = f"{tenant['organization_id']}:{tenant['workspace_id']}:" if tenant else ""
+    ids = []
+    occurrences = {}
+    for split in splits:
+        fingerprint = SQLiteEmbeddingCache.text_hash(
+            split.page_content + "\x00" + json.dumps(split.metadata, sort_keys=True, default=str)
+        )
+        position = occurrences.get(fingerprint, 0)
+        occurrences[fingerprint] = position + 1
+        ids.append(str(uuid.uuid5(POINT_ID_NAMESPACE, f"{scope}{file_id}:{fingerprint}:{position}")))
+    return ids
+
+
+def add_splits(vectorstore: QdrantVectorStore, splits: List[Document], ids: Optional[List[str]] = None,
+               progress=None, batch_size: Optional[int] = None, staged: bool = False) -> dict:
+    """ Embed splits in batches through the embedding cache and upsert each batch while the following
+    batches are still embedding. Returns cache hit/miss counts and throughput.
+    progress(stage, count) is called with "embedded" and "upserted" as the work completes.
+    With staged=True the points are written hidden from search (see update_document_splits). """
+    start = time.perf_counter()
+    stats = {"chunks": len(splits), "hits": 0, "misses": 0}
+    ids = ids or [uuid.uuid4().hex for _ in splits]
+    batch_size = batch_size or EMBED_BATCH_SIZE
+
+    in_flight = deque()
     try:
-        if file_path.endswith('.json'):
-            with open(file_path, "r") as file:
-
-                data = json.load(file)
-        else:
-            raise ValueError(f"Unsupported file type: {file_path}")
-        documents = text_splitter.create_documents(texts=[data], convert_lists=True)
-        return documents
-    except Exception as e:
-        print(f"Error loading document: {e}")
+        for offset in range(0, len(splits), batch_size):
+            batch_splits = splits[offset:offset + batch_size]
+            batch_ids = ids[offset:offset + batch_size]
+            # Run in a copy of the current context so the batch span nests under the caller's trace
+            future = embedding_executor.submit(
+                contextvars.copy_context().run, _embed_batch, vectorstore.labels,
+                [split.page_content for split in batch_splits]
+            )
+            in_flight.append((batch_splits, batch_ids, future))
+            if len(in_flight) >= EMBED_BATCHES_IN_FLIGHT:
+                _upsert_batch(vectorstore, *in_flight.popleft(), stats, progress, staged)
+        while in_flight:
+            _upsert_batch(vectorstore, *in_flight.popleft(), stats, progress, staged)
+    finally:
+        for _, _, future in in_flight:
+            future.cancel()
+
+    stats["seconds"] = time.perf_counter() - start
+    stats["chunks_per_second"] = len(splits) / stats["seconds"] if splits and stats["seconds"] else 0.0
+    if splits:
+        INGESTION_CHUNKS_PER_SECOND.labels(**tenant(**vectorstore.labels)).observe(stats["chunks_per_second"])
+    return stats
+
+
+def _embed_batch(labels: dict, texts: List[str]):
+    with stage("embed_batch", **labels, chunks=len(texts)):
+        return embedding_function.embed_documents_with_stats(texts)
 
 
+def _upsert_batch(vectorstore: QdrantVectorStore, splits: List[Document], ids: List[str], future, stats: dict,
+                  progress=None, staged: bool = False):
+    vectors, batch_stats = future.result()
+    stats["hits"] += batch_stats["hits"]
+    stats["misses"] += batch_stats["misses"]
+    _report(progress, "embedded", len(vectors))
+    INGESTED_CHUNKS.labels(stage="embedded", **tenant(**vectorstore.labels)).inc(len(vectors))
+
+    if vectorstore.has_sparse_vectors:
+        sparse_vectors = vectorstore.sparse_embeddings.embed_documents([split.page_content for split in splits])
+        vectors = [
+            {
+                vectorstore.vector_name: vector,
+                vectorstore.sparse_vector_name: models.SparseVector(indices=sparse.indices, values=sparse.values),
+            }
+            for vector, sparse in zip(vectors, sparse_vectors)
+        ]
+    elif vectorstore.vector_name:
+        vectors = [{vectorstore.vector_name: vector} for vector in vectors]
+
+    points = [
+        models.PointStruct(
+            id=point_id,
+            vector=vector,
+            payload={
+                vectorstore.content_payload_key: split.page_content,
+                vectorstore.metadata_payload_key: {**split.metadata, **vectorstore.tenant,
+                                                   **({"staged": True} if staged else {})},
+            },
+        )
+        for point_id, split, vector in zip(ids, splits, vectors)
+    ]
+    with qdrant_write_slots, stage("qdrant_upsert", **vectorstore.labels, points=len(points)):
+        vectorstore.client.upsert(collection_name=vectorstore.collection_name, points=points)
+    _report(progress, "upserted", len(points))
+    INGESTED_CHUNKS.labels(stage="upserted", **tenant(**vectorstore.labels)).inc(len(points))
+
 
-def index_document_to_chroma(file_path: str, organization_id: str, workspace_id: str , file_id: str) -> bool:
+def get_file_point_ids(vectorstore: QdrantVectorStore, file_id: str, searchable_only: bool = False) -> set:
+    """ IDs of every point currently indexed for file_id; with searchable_only, leaving out staged points """
+    file_filter = vectorstore.scoped_filter(models.Filter(
+        must=[models.FieldCondition(key="metadata.file_id", match=models.MatchValue(value=file_id))],
+        must_not=[STAGED] if searchable_only else None,
+    ))
+    point_ids = set()
+    offset = None
+    while True:
+        points, offset = vectorstore.client.scroll(
+            collection_name=vectorstore.collection_name,
+            scroll_filter=file_filter,
+            limit=1000,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False,
+        )
+        point_ids.update(str(point.id) for point in points)
+        if offset is None:
+            return point_ids
+
+
+def index_document_to_chroma(file: FileUpload, organization_id: str, workspace_id: str , file_id: str, progress=None) -> bool:
     try:
-        splits = load_and_split_document(file_path)
+        splits = prepare_splits(file, file_id)
+        _report(progress, "split", len(splits))
         vectorstore = get_org_workspace_vectorstore(organization_id, workspace_id)
 
-        # Add metadata to each split
-        for split in splits:
-            split.metadata['file_id'] = file_id
-
-        vectorstore.add_documents(splits)
+        stats = add_splits(vectorstore, splits, chunk_point_ids(file_id, splits, vectorstore.tenant), progress)
+        logger.info(f"Indexed file_id {file_id}: {len(splits)} splits, embedding cache {stats['hits']} hits / {stats['misses']} misses, "
+                    f"{stats['chunks_per_second']:.1f} chunks/s")
         return True
     except Exception as e:
-        print(f"Error indexing document: {e}")
+        logger.exception(f"Error indexing document: {e}")
         return False
 
 
@@ -86,32 +677,75 @@ def delete_doc_from_chroma(organization_id: str, workspace_id: str, file_id: str
         deletion_result = vectorstore.client.delete(
             collection_name=vectorstore.collection_name,
             points_selector=models.FilterSelector(
-                filter=delete_filter
+                filter=vectorstore.scoped_filter(delete_filter)
             )
         )
         return True
 
     except Exception as e:
-        print(f"Error deleting document with file_id {file_id} from Qdrant: {e}")
+        logger.exception(f"Error deleting document with file_id {file_id} from Qdrant: {e}")
         return False
 
-def update_document_splits(file_path: str, organization_id: str, workspace_id: str, file_id: str) -> bool:
+def update_document_splits(file: FileUpload, organization_id: str, workspace_id: str, file_id: str, progress=None) -> bool:
+    """ Incrementally re-index a document: upsert only new or changed chunks, then delete the stale ones.
+    The changed chunks are written staged, hidden from search, while the previous version keeps serving.
+    A single batched request then unstages them and deletes the stale chunks. If anything fails before that
+    switch, the staged chunks are deleted and the previous version is left as it was. """
     try:
-        if not delete_doc_from_chroma(organization_id, workspace_id, file_id):
-            print(f"Failed to delete existing splits for file_id {file_id}")
-            return False
-
-        splits = load_and_split_document(file_path)
+        splits = prepare_splits(file, file_id)
         if not splits:
-            print("No splits returned from the document loader.")
+            logger.error(f"No splits returned from the document loader for file_id {file_id}.")
             return False
+        _report(progress, "split", len(splits))
 
         vectorstore = get_org_workspace_vectorstore(organization_id, workspace_id)
-        for split in splits:
-            split.metadata['file_id'] = file_id
 
-        vectorstore.add_documents(splits)
-        return True
+        new_ids = chunk_point_ids(file_id, splits, vectorstore.tenant)
+        # Staged points left by an update that died mid-way count as stale, not as already indexed
+        existing_ids = get_file_point_ids(vectorstore, file_id)
+        live_ids = get_file_point_ids(vectorstore, file_id, searchable_only=True)
+    except Exception as e:
+        logger.exception(f"Error updating splits for file_id {file_id}: {e}")
+        return False
+
+    changed = [(point_id, split) for point_id, split in zip(new_ids, splits) if point_id not in live_ids]
+    changed_ids = [point_id for point_id, _ in changed]
+    try:
+        stats = add_splits(vectorstore, [split for _, split in changed], changed_ids, progress, staged=True)
+    except Exception as e:
+        logger.exception(f"Error updating splits for file_id {file_id}: {e}")
+        _discard_points(vectorstore, changed_ids)
+        return False
+
+    stale_ids = list(existing_ids - set(new_ids))
+    switch = []
+    if changed_ids:
+        switch.append(models.DeletePayloadOperation(
+            delete_payload=models.DeletePayload(keys=[STAGED_KEY], points=changed_ids)
+        ))
+    if stale_ids:
+        switch.append(models.DeleteOperation(delete=models.PointIdsList(points=stale_ids)))
+    try:
+        if switch:
+            vectorstore.client.batch_update_points(collection_name=vectorstore.collection_name,
+                                                   update_operations=switch)
     except Exception as e:
-        print(f"Error updating splits for file_id {file_id}: {e}")
+        # Part of the switch may have been applied, so keep the staged points; the next update reconciles them
+        logger.exception(f"Error switching file_id {file_id} to its new version: {e}")
         return False
+
+    logger.info(f"Updated file_id {file_id}: {len(splits) - len(changed)} unchanged, {len(changed)} upserted, "
+                f"{len(stale_ids)} removed, embedding cache {stats['hits']} hits / {stats['misses']} misses, "
+                f"{stats['chunks_per_second']:.1f} chunks/s")
+    return True
+
+
+def _discard_points(vectorstore: QdrantVectorStore, point_ids: List[str]):
+    """ Best-effort removal of the staged points of a failed update; they are hidden from search either way """
+    if not point_ids:
+        return
+    try:
+        vectorstore.client.delete(collection_name=vectorstore.collection_name,
+                                  points_selector=models.PointIdsList(points=point_ids))
+    except Exception as e:
+        logger.warning(f"Could not remove {len(point_ids)} staged points: {e}")
@@ -0,0 +1,69 @@
+import logging
+import os
+import threading
+from typing import List, Optional
+
+from langchain_core.documents import Document
+
+from prompt_utils import estimate_tokens, CONTEXT_TOKEN_BUDGET
+
+# Optional rerank stage: over-fetch RERANK_CANDIDATES chunks, rescore them with a small cross-encoder and
+# keep the best ones until the context reaches CONTEXT_TOKEN_BUDGET. Needs sentence-transformers installed.
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "false").lower() == "true"
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "20"))
+
+
+class CrossEncoderReranker:
+    """ Rescores (question, chunk) pairs with a cross-encoder and fills a token budget with the best chunks """
+
+    def __init__(self, model_name: str, token_budget: int):
+        self.model_name = model_name
+        self.token_budget = token_budget
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _get_model(self):
+        # Loaded on first use so importing the API does not pull in torch
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import CrossEncoder
+                    self._model = CrossEncoder(self.model_name, device="cpu")
+        return self._model
+
+    def rerank(self, question: str, docs: List[Document]) -> List[Document]:
+        """ Return docs ordered by relevance, cut off at the token budget; the best chunk is always kept """
+        if not docs:
+            return docs
+        scores = self._get_model().predict([(question, doc.page_content) for doc in docs])
+        ranked = sorted(zip(docs, scores), key=lambda pair: pair[1], reverse=True)
+
+        selected = []
+        used = 0
+        for doc, score in ranked:
+            tokens = estimate_tokens(doc.page_content)
+            if selected and used + tokens > self.token_budget:
+                continue
+            doc.metadata["rerank_score"] = float(score)
+            selected.append(doc)
+            used += tokens
+        return selected
+
+
+_reranker = None
+
+
+def get_reranker() -> Optional[CrossEncoderReranker]:
+    """ The shared reranker, or None when reranking is disabled or sentence-transformers is missing """
+    global _reranker
+    if not RERANK_ENABLED:
+        return None
+    if _reranker is None:
+        try:
+            import sentence_transformers  # noqa: F401
+        except ImportError:
+            logging.warning("RERANK_ENABLED is set but sentence-transformers is not installed; reranking is disabled")
+            return None
+        _reranker = CrossEncoderReranker(RERANK_MODEL, CONTEXT_TOKEN_BUDGET)
+    return _reranker
@@ -0,0 +1,50 @@
+import re
+import zlib
+from collections import Counter
+from typing import List
+
+from langchain_qdrant import SparseEmbeddings, SparseVector
+
+
+class BM25SparseEmbeddings(SparseEmbeddings):
+    """ Local BM25 term weights, hashed into a sparse vector. Documents carry only the saturated term-frequency
+    part; the collection's sparse vector uses Modifier.IDF so Qdrant applies the inverse document frequency. """
+
+    # Clause numbers like 4.2.1 stay one token; everything else splits on non-letters
+    TOKEN_PATTERN = re.compile(r"\d+(?:\.\d+)*|[^\W\d_]+")
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75, avg_doc_length: float = 256):
+        self.k1 = k1
+        self.b = b
+        self.avg_doc_length = avg_doc_length
+
+    def tokenize(self, text: str) -> List[str]:
+        return self.TOKEN_PATTERN.findall(text.lower())
+
+    @staticmethod
+    def _token_index(token: str) -> int:
+        # Stable across processes, unlike hash()
+        return zlib.crc32(token.encode("utf-8"))
+
+    def _to_sparse(self, weights: dict) -> SparseVector:
+        # Tokens whose hashes collide share one dimension
+        merged = {}
+        for token, weight in weights.items():
+            index = self._token_index(token)
+            merged[index] = merged.get(index, 0.0) + weight
+        return SparseVector(indices=list(merged.keys()), values=list(merged.values()))
+
+    def embed_documents(self, texts: List[str]) -> List[SparseVector]:
+        vectors = []
+        for text in texts:
+            tokens = self.tokenize(text)
+            length_norm = self.k1 * (1 - self.b + self.b * len(tokens) / self.avg_doc_length)
+            weights = {
+                token: count * (self.k1 + 1) / (count + length_norm)
+                for token, count in Counter(tokens).items()
+            }
+            vectors.append(self._to_sparse(weights))
+        return vectors
+
+    def embed_query(self, text: str) -> SparseVector:
+        return self._to_sparse({token: 1.0 for token in self.tokenize(text)})
@@ -0,0 +1,79 @@
+import json
+
+from fastapi.responses import StreamingResponse
+
+
+def _partial_tag_length(text: str, tag: str) -> int:
+    """ Length of the longest suffix of text that is a proper prefix of tag """
+    for size in range(min(len(text), len(tag) - 1), 0, -1):
+        if text.endswith(tag[:size]):
+            return size
+    return 0
+
+
+class ThinkTagFilter:
+    """ Streaming equivalent of remove_think_tags: drops <think>...</think> spans from a token
+    stream, even when a tag is split across chunks """
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self._buffer = ""
+        self._inside = False
+        self._started = False
+
+    def feed(self, chunk: str) -> str:
+        """ Consume a chunk and return the text that is safe to emit now """
+        self._buffer += chunk
+        output = []
+        while True:
+            tag = self.CLOSE_TAG if self._inside else self.OPEN_TAG
+            index = self._buffer.find(tag)
+            if index != -1:
+                if not self._inside:
+                    output.append(self._buffer[:index])
+                self._buffer = self._buffer[index + len(tag):]
+                self._inside = not self._inside
+                continue
+
+            # Hold back a possible partial tag until the next chunk decides it
+            keep = _partial_tag_length(self._buffer, tag)
+            if not self._inside:
+                output.append(self._buffer[:len(self._buffer) - keep])
+            self._buffer = self._buffer[len(self._buffer) - keep:]
+            return self._emit("".join(output))
+
+    def flush(self) -> str:
+        """ Return whatever is still buffered once the stream has ended """
+        text = "" if self._inside else self._buffer
+        self._buffer = ""
+        return self._emit(text)
+
+    def _emit(self, text: str) -> str:
+        # Match remove_think_tags' strip() for the leading whitespace left behind a think block
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        return text
+
+
+def format_sse(event: str, data: dict) -> str:
+    """ Format one Server-Sent Event """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class ReleasingStreamingResponse(StreamingResponse):
+    """ StreamingResponse that calls on_close once sending ends, however it ends. A body generator's own
+    finally block does not run when the server never starts iterating it (e.g. the client is already gone),
+    so resources held for the stream must not rely on it alone. """
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
@@ -1,3 +1,4 @@
+import json
 import requests
 import streamlit as st
 
@@ -29,6 +30,45 @@ def get_api_response(question, session_id, model, organization_id, workspace_id,
         st.error(f"An error occurred: {str(e)}")
         return None
 
+def stream_api_response(question, session_id, model, organization_id, workspace_id, file_id=None, details=None):
+    """ Yield answer tokens from the /chat/stream SSE endpoint; session_id/model land in details """
+    headers = {
+        'accept': 'text/event-stream',
+        'Content-Type': 'application/json'
+    }
+    data = {
+        "question": question,
+        "model": model,
+        "organization_id": organization_id,
+        "workspace_id": workspace_id
+    }
+    if session_id:
+        data["session_id"] = session_id
+    if file_id:
+        data["file_id"] = file_id
+    details = details if details is not None else {}
+
+    try:
+        with requests.post("http://localhost:8000/chat/stream", headers=headers, json=data, stream=True) as response:
+            if response.status_code != 200:
+                st.error(f"API request failed with status code {response.status_code}: {response.text}")
+                return
+
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    payload = json.loads(line[len("data:"):].strip())
+                    if event == "token":
+                        yield payload["token"]
+                    elif event == "done":
+                        details.update(payload)
+                    elif event == "error":
+                        st.error(f"An error occurred: {payload.get('detail')}")
+    except Exception as e:
+        st.error(f"An error occurred: {str(e)}")
+
 def upload_document(organization_id,workspace_id, file_id, file):
     print("Uploading file...")
     try:
@@ -43,17 +83,32 @@ def upload_document(organization_id,workspace_id, file_id, file):
         st.error(f"An error occurred while uploading the file: {str(e)}")
         return None
 
-def list_documents(organization_id,workspace_id):
+# Listings are paginated by the API; the sidebar fetches one page at a time instead of holding everything
+PAGE_SIZE = 50
+
+def _get_page(url, cursor=None):
+    """ Fetch one page; returns (response, items, next_cursor) """
+    params = {"limit": PAGE_SIZE}
+    if cursor:
+        params["cursor"] = cursor
+    response = requests.get(url, params=params)
+    if response.status_code != 200:
+        return response, [], None
+    return response, response.json(), response.headers.get("X-Next-Cursor")
+
+def list_documents(organization_id, workspace_id, cursor=None):
+    """ One page of a workspace's documents; returns (documents, next_cursor) """
     try:
-        response = requests.get(f"http://localhost:8000/list-docs/organization/{organization_id}/workspace/{workspace_id}")
+        response, documents, next_cursor = _get_page(
+            f"http://localhost:8000/list-docs/organization/{organization_id}/workspace/{workspace_id}", cursor)
         if response.status_code == 200:
-            return response.json()
+            return documents, next_cursor
         else:
             st.error(f"Failed to fetch document list. Error: {response.status_code} - {response.text}")
-            return []
+            return [], None
     except Exception as e:
         st.error(f"An error occurred while fetching the document list: {str(e)}")
-        return []
+        return [], None
 
 def delete_document(organization_id,workspace_id, file_id):
     headers = {
@@ -73,16 +128,19 @@ def delete_document(organization_id,workspace_id, file_id):
         st.error(f"An error occurred while deleting the document: {str(e)}")
         return None
 
-def fetch_organizations():
-    """ Fetch all organizations from API """
-    response = requests.get("http://localhost:8000/organizations/")
+# The sidebar runs on every Streamlit rerun, so keep these pages for a short while
+@st.cache_data(ttl=60)
+def fetch_organizations(cursor=None):
+    """ One page of organizations; returns (organizations, next_cursor) """
+    response, organizations, next_cursor = _get_page("http://localhost:8000/organizations/", cursor)
     if response.status_code == 200:
-        return response.json()
-    return []
+        return organizations, next_cursor
+    return [], None
 
-def fetch_workspaces(organization_id):
-    """ Fetch all workspaces from API based on selected organization """
-    response = requests.get(f"http://localhost:8000/workspaces/{organization_id}")
+@st.cache_data(ttl=60)
+def fetch_workspaces(organization_id, cursor=None):
+    """ One page of an organization's workspaces; returns (workspaces, next_cursor) """
+    response, workspaces, next_cursor = _get_page(f"http://localhost:8000/workspaces/{organization_id}", cursor)
     if response.status_code == 200:
-        return response.json()
-    return []
\ No newline at end of file
+        return workspaces, next_cursor
+    return [], None
@@ -1,5 +1,5 @@
 import streamlit as st
-from api_utils import get_api_response
+from api_utils import stream_api_response
 
 def display_chat_interface():
     # Chat interface
@@ -12,28 +12,24 @@ def display_chat_interface():
         with st.chat_message("user"):
             st.markdown(prompt)
 
-        with st.spinner("Generating response..."):
-            selected_file_id=st.session_state.get("selected_document_id", None)
-            if selected_file_id:
-                response = get_api_response(prompt, st.session_state.session_id, st.session_state.model,
-                                            st.session_state.organization_id, st.session_state.workspace_id, selected_file_id)
-            else:
-                response = get_api_response(prompt, st.session_state.session_id, st.session_state.model,
-                                            st.session_state.organization_id, st.session_state.workspace_id)
-
-            if response:
-                st.session_state.session_id = response.get('session_id')
-                st.session_state.messages.append({"role": "assistant", "content": response['answer']})
+        selected_file_id = st.session_state.get("selected_document_id", None)
+        details = {}
+        with st.chat_message("assistant"):
+            # Render tokens as they arrive instead of waiting for the full answer
+            answer = st.write_stream(stream_api_response(prompt, st.session_state.session_id, st.session_state.model,
+                                                         st.session_state.organization_id, st.session_state.workspace_id,
+                                                         selected_file_id, details))
 
-                with st.chat_message("assistant"):
-                    st.markdown(response['answer'])
+            if details:
+                st.session_state.session_id = details.get('session_id')
+                st.session_state.messages.append({"role": "assistant", "content": answer})
 
-                    with st.expander("Details"):
-                        st.subheader("Generated Answer")
-                        st.code(response['answer'])
-                        st.subheader("Model Used")
-                        st.code(response['model'])
-                        st.subheader("Session ID")
-                        st.code(response['session_id'])
+                with st.expander("Details"):
+                    st.subheader("Generated Answer")
+                    st.code(answer)
+                    st.subheader("Model Used")
+                    st.code(details['model'])
+                    st.subheader("Session ID")
+                    st.code(details['session_id'])
             else:
                 st.error("Failed to get a response from the API. Please try again.")
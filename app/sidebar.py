@@ -3,14 +3,59 @@ import uuid  # To generate unique file IDs
 from api_utils import upload_document, list_documents, delete_document, fetch_organizations, fetch_workspaces
 
 
+# Organizations and workspaces are loaded a page at a time; "Load more" appends the next page
+def _loaded_options(key, fetch, *args):
+    """ Pages of a listing loaded so far; starts over when the parent selection (args) changes """
+    state = st.session_state.get(key)
+    if state is None or state["args"] != args:
+        items, next_cursor = fetch(*args)
+        state = {"args": args, "items": items, "next_cursor": next_cursor}
+        st.session_state[key] = state
+    return state
+
+def _load_more(key, fetch):
+    state = st.session_state[key]
+    items, next_cursor = fetch(*state["args"], state["next_cursor"])
+    state["items"] = state["items"] + items
+    state["next_cursor"] = next_cursor
+
+
+# Documents are shown one page at a time; only the current page is kept
+def _document_page(reset=False):
+    args = (st.session_state["organization_id"], st.session_state["workspace_id"])
+    state = st.session_state.get("document_page")
+    if reset or state is None or state["args"] != args:
+        # cursors[i] is the cursor that fetches page i; the first page has none
+        state = {"args": args, "cursors": [None]}
+        st.session_state["document_page"] = state
+        _fetch_documents(state)
+    return state
+
+def _fetch_documents(state):
+    if all(state["args"]):
+        state["documents"], state["next_cursor"] = list_documents(*state["args"], state["cursors"][-1])
+    else:
+        state["documents"], state["next_cursor"] = [], None
+
+def _next_documents():
+    state = st.session_state["document_page"]
+    state["cursors"].append(state["next_cursor"])
+    _fetch_documents(state)
+
+def _previous_documents():
+    state = st.session_state["document_page"]
+    state["cursors"].pop()
+    _fetch_documents(state)
+
+
 def display_sidebar():
     # Sidebar: Model Selection
     model_options = ["llama3.2"]
     st.sidebar.selectbox("Select Model", options=model_options, key="model")
 
     # Fetch organizations dynamically
-    organizations = fetch_organizations()
-    org_options = ["Select a company"] + [org["id"] for org in organizations]
+    organization_pages = _loaded_options("organization_pages", fetch_organizations)
+    org_options = ["Select a company"] + [org["id"] for org in organization_pages["items"]]
 
     # Organization Selection
     selected_organization = st.sidebar.selectbox(
@@ -20,6 +65,9 @@ def display_sidebar():
         key="selected_organization"
     )
 
+    if organization_pages["next_cursor"]:
+        st.sidebar.button("Load more companies", on_click=_load_more, args=("organization_pages", fetch_organizations))
+
     # Store selected organization ID
     if selected_organization != "Select a company":
         st.session_state["organization_id"] = selected_organization
@@ -27,7 +75,11 @@ def display_sidebar():
         st.session_state["organization_id"] = None
 
     # Fetch workspaces dynamically when an organization is selected
-    workspaces = fetch_workspaces(st.session_state["organization_id"]) if st.session_state["organization_id"] else []
+    workspaces = []
+    workspace_pages = None
+    if st.session_state["organization_id"]:
+        workspace_pages = _loaded_options("workspace_pages", fetch_workspaces, st.session_state["organization_id"])
+        workspaces = workspace_pages["items"]
     workspace_options = ["Select a workspace"] + [ws["id"] for ws in workspaces]
 
     # Workspace Selection
@@ -38,6 +90,9 @@ def display_sidebar():
         key="selected_workspace"
     )
 
+    if workspace_pages and workspace_pages["next_cursor"]:
+        st.sidebar.button("Load more workspaces", on_click=_load_more, args=("workspace_pages", fetch_workspaces))
+
     # Store selected workspace ID
     if selected_workspace != "Select a workspace":
         st.session_state["workspace_id"] = selected_workspace
@@ -52,18 +107,11 @@ def display_sidebar():
     st.sidebar.header("Uploaded Documents")
     if st.sidebar.button("Refresh Document List"):
         with st.spinner("Refreshing..."):
-            st.session_state["documents"] = list_documents(
-                st.session_state["organization_id"], st.session_state["workspace_id"]
-            )
+            _document_page(reset=True)
             st.session_state["selected_document_id"]= None
 
-    # Initialize document list if not present
-    if "documents" not in st.session_state:
-        st.session_state["documents"] = list_documents(
-            st.session_state["organization_id"], st.session_state["workspace_id"]
-        )
-
-    documents = st.session_state["documents"]
+    document_page = _document_page()
+    documents = document_page["documents"]
     if documents:
         for doc in documents:
             st.sidebar.text(f"{doc['filename']} (ID: {doc['file_id']}, Uploaded: {doc['upload_timestamp']})")
@@ -76,4 +124,9 @@ def display_sidebar():
             key="selected_file_id"  # Unique key added
         )
 
-        st.session_state["selected_document_id"]=None if selected_file_id =="None" else selected_file_id
\ No newline at end of file
+        st.session_state["selected_document_id"]=None if selected_file_id =="None" else selected_file_id
+
+    # Page controls for the document list
+    previous_col, next_col = st.sidebar.columns(2)
+    previous_col.button("Previous page", on_click=_previous_documents, disabled=len(document_page["cursors"]) == 1)
+    next_col.button("Next page", on_click=_next_documents, disabled=not document_page["next_cursor"])